@@ -0,0 +1,136 @@
+# -*- coding: utf-8 -*-
+"""
+Spectral Angle Mapper (SAM) and Spectral Information Divergence (SID) classifiers for NEON AOP
+reflectance, computed with matrix products over chunks of pixels.
+
+The SAM and SID functions in classification_endmember_extraction_py wrap the pysptools
+classifiers. Here SAM angles for a chunk of pixels are one normalized (pixels x bands) .
+(bands x endmembers) product, and SID uses precomputed endmember log-probabilities so it is two
+matrix products plus per-pixel and per-endmember entropy terms. Chunks are small enough to
+stay in cache, and the arithmetic can run in float32.
+
+Class maps follow the pysptools convention: classes are numbered 1..p in the order of the
+endmembers and 0 is unclassified (NaN pixels, or distance above the class threshold).
+"""
+
+import numpy as np
+from neon_aop_hyperspectral import ReflectanceTile
+
+#pixels per chunk: 4096 pixels x 360 bands x 4 bytes is ~6 MB
+CHUNK_SIZE = 4096
+
+#probabilities are clipped to EPSILON before taking logs, so zero or negative reflectance is allowed
+EPSILON = 1e-12
+
+def _sam_prepare(E,dtype):
+    E = np.asarray(E,dtype=dtype)
+    return E/np.linalg.norm(E,axis=1,keepdims=True)
+
+def _sam_distance(pixels,E_unit):
+    # spectral angles (radians) between each pixel and each endmember, (pixels x endmembers)
+    norms = np.linalg.norm(pixels,axis=1,keepdims=True)
+    with np.errstate(invalid='ignore',divide='ignore'):
+        cos = pixels.dot(E_unit.T)/norms
+    return np.arccos(np.clip(cos,-1,1))
+
+def _sid_prepare(E,dtype):
+    E = np.clip(np.asarray(E,dtype=dtype),EPSILON,None)
+    Q = E/E.sum(axis=1,keepdims=True)
+    logQ = np.log(Q)
+    return Q, logQ, (Q*logQ).sum(axis=1)
+
+def _sid_distance(pixels,prepared):
+    # SID = sum (p - q)(log p - log q) = sum p log p + sum q log q - p . log q - log p . q
+    Q, logQ, q_entropy = prepared
+    pixels = np.clip(pixels,EPSILON,None)
+    P = pixels/pixels.sum(axis=1,keepdims=True)
+    logP = np.log(P)
+    p_entropy = np.einsum('ij,ij->i',P,logP)
+    return p_entropy[:,None] + q_entropy[None,:] - P.dot(logQ.T) - logP.dot(Q.T)
+
+_METHODS = {'sam':(_sam_prepare,_sam_distance),'sid':(_sid_prepare,_sid_distance)}
+
+def classify_pixels(pixels,E,method='sam',thresholds=None,chunk_size=CHUNK_SIZE,dtype=np.float32,
+                    return_distance=False):
+    """
+    classify_pixels assigns each pixel of a (pixels x bands) array to the closest endmember
+    --------
+     Inputs:
+         pixels: (pixels x bands) reflectance array
+         E: endmembers (p x bands), eg. U from NFINDR
+         method: 'sam' (spectral angle, radians) or 'sid' (spectral information divergence)
+         thresholds: None, a single value, or one value per class; pixels whose distance to the
+                     closest endmember is above its class threshold are unclassified (0)
+         chunk_size: number of pixels evaluated at a time; default CHUNK_SIZE
+         dtype: np.float32 (default) or np.float64 arithmetic
+         return_distance: also return the distance to the assigned endmember; default False
+    --------
+     Returns:
+         labels (pixels,) uint16 with classes 1..p and 0 unclassified [, distance (pixels,)]
+    """
+    prepare, distance = _METHODS[method]
+    prepared = prepare(E,dtype)
+    n = pixels.shape[0]
+    p = np.asarray(E).shape[0]
+    if thresholds is not None:
+        thresholds = np.broadcast_to(np.asarray(thresholds,dtype=dtype),(p,))
+    labels = np.zeros(n,dtype=np.uint16)
+    min_distance = np.full(n,np.nan,dtype=dtype) if return_distance else None
+    for start in range(0,n,chunk_size):
+        chunk = np.asarray(pixels[start:start+chunk_size],dtype=dtype)
+        valid = ~np.isnan(chunk).any(axis=1)
+        if not valid.any():
+            continue
+        d = distance(chunk[valid],prepared)
+        best = np.argmin(d,axis=1)
+        best_distance = d[np.arange(len(best)),best]
+        chunk_labels = (best + 1).astype(np.uint16)
+        if thresholds is not None:
+            chunk_labels[best_distance > thresholds[best]] = 0
+        labels[start:start+chunk_size][valid] = chunk_labels
+        if return_distance:
+            min_distance[start:start+chunk_size][valid] = best_distance
+    if return_distance:
+        return labels, min_distance
+    return labels
+
+def SAM(data,E,thrs=None,chunk_size=CHUNK_SIZE,dtype=np.float32):
+    """
+    SAM classifies a (rows, columns, bands) reflectance array with the Spectral Angle Mapper and
+    returns the class map (rows, columns); thrs are angles in radians (single value or one per class)
+    --------
+    Usage:
+    --------
+    sam_map = SAM(data_clean,U2,[0.1,0.1,0.1])
+    """
+    labels = classify_pixels(data.reshape(-1,data.shape[-1]),E,'sam',thrs,chunk_size,dtype)
+    return labels.reshape(data.shape[:-1])
+
+def SID(data,E,thrs=None,chunk_size=CHUNK_SIZE,dtype=np.float32):
+    """
+    SID classifies a (rows, columns, bands) reflectance array with Spectral Information Divergence
+    and returns the class map (rows, columns); thrs is a single value or one per class
+    --------
+    Usage:
+    --------
+    sid_map = SID(data_clean,U2,[0.8,0.3,0.03])
+    """
+    labels = classify_pixels(data.reshape(-1,data.shape[-1]),E,'sid',thrs,chunk_size,dtype)
+    return labels.reshape(data.shape[:-1])
+
+def classify_file(refl_filename,E,method='sam',thresholds=None,block_size=(256,256),dtype=np.float32):
+    """
+    classify_file classifies a reflectance h5 file (tile or flightline) window by window, with the
+    bad bands removed during the read (ReflectanceTile.read_clean), so E must have the same
+    cleaned bands as data_clean in the endmember extraction tutorial
+    --------
+     Returns:
+         class map (rows, columns) uint16, 1..p and 0 unclassified
+    """
+    with ReflectanceTile(refl_filename) as tile:
+        class_map = np.zeros(tile.shape[:2],dtype=np.uint16)
+        for window in tile.iter_windows(block_size):
+            refl = tile.read_clean(window,dtype)
+            labels = classify_pixels(refl.reshape(-1,refl.shape[2]),E,method,thresholds,dtype=dtype)
+            class_map[window[0][0]:window[0][1],window[1][0]:window[1][1]] = labels.reshape(refl.shape[:2])
+    return class_map
@@ -0,0 +1,406 @@
+# -*- coding: utf-8 -*-
+"""
+Functions and classes to read NEON AOP hyperspectral reflectance hdf5 files without loading
+the full reflectance cube into memory.
+
+aop_h5refl2array and read_neon_reflh5 in the hyperspectral tutorials read all of
+Reflectance_Data (eg. 1000 x 1000 x 426 int16) and convert it to float64 (~3.4 GB).
+ReflectanceTile instead keeps the hdf5 file open and reads only the rows, columns, and
+bands requested, applying the no data value and reflectance scale factor to that window.
+clean_neon_refl_data and ReflectanceTile.read_clean write the cleaned reflectance (bad bands
+removed) into a single float32 output buffer instead of several full-size float64 copies.
+
+ReflectanceMetadata parses the metadata of a file once (Map_Info, EPSG, wavelengths, bad band
+windows) and caches the geotransform and extent, with vectorized world <-> pixel conversions.
+
+The stock files store Reflectance_Data pixel-interleaved (rows, columns, bands), so reading one
+band touches the whole dataset. repackage_reflectance writes a copy with the same structure
+(readable with ReflectanceTile) but with band-sequential or pixel-spectral compressed chunks.
+"""
+
+import numpy as np
+import h5py
+
+#chunk shapes (rows, columns, bands) for repackage_reflectance; None is replaced by all bands
+CHUNK_LAYOUTS = {
+    'band': (256,256,1),       #band-sequential: single band images read O(band) chunks
+    'spectral': (16,16,None),  #pixel-spectral: single spectra read one chunk
+}
+
+def valid_band_ranges(metadata):
+    """
+    valid_band_ranges returns the (start, stop) band index ranges kept after removing the
+    water vapor bad band windows and the last 10 bands, matching clean_neon_refl_data in
+    the endmember extraction tutorial:
+        Band_Window_1_Nanometers = 1340,1445
+        Band_Window_2_Nanometers = 1790,1955
+    Accepts metadata from read_neon_reflh5 ('bad_band_window1') or aop_h5refl2array /
+    ReflectanceTile ('bad band window1').
+    """
+    wavelength = np.asarray(metadata['wavelength'])
+    bbw1 = metadata['bad_band_window1'] if 'bad_band_window1' in metadata else metadata['bad band window1']
+    bbw2 = metadata['bad_band_window2'] if 'bad_band_window2' in metadata else metadata['bad band window2']
+    bb1_ind0 = np.max(np.where(wavelength < float(bbw1[0])))
+    bb1_ind1 = np.min(np.where(wavelength > float(bbw1[1])))
+    bb2_ind0 = np.max(np.where(wavelength < float(bbw2[0])))
+    bb2_ind1 = np.min(np.where(wavelength > float(bbw2[1])))
+    bb3_ind0 = len(wavelength) - 10
+    return [(0,int(bb1_ind0)),(int(bb1_ind1),int(bb2_ind0)),(int(bb2_ind1),int(bb3_ind0))]
+
+def valid_band_indices(metadata):
+    # indices of the bands kept by clean_neon_refl_data, as a numpy array
+    return np.concatenate([np.arange(start,stop) for start, stop in valid_band_ranges(metadata)])
+
+def _clean_into(raw,out,no_data,scale_factor):
+    # scale a raw int16 block into the float output block and set no data to NaN, in place
+    np.divide(raw,scale_factor,out=out,casting='unsafe')
+    np.copyto(out,np.nan,where=(raw == no_data))
+
+def clean_neon_refl_data(data,metadata,dtype=np.float32):
+    """
+    clean_neon_refl_data cleans h5 reflectance data and metadata in one pass into a single
+    output array of the selected dtype (float32 by default):
+    1. set data ignore value (-9999) to NaN
+    2. apply reflectance scale factor (10000)
+    3. remove bad bands (water vapor band windows + last 10 bands), see valid_band_ranges
+    The input data is not modified; each valid band range is scaled straight from a view of
+    the raw array into its slice of the output, so no full-size temporaries are made.
+    --------
+    Usage:
+    --------
+    data_clean, metadata_clean = clean_neon_refl_data(data,metadata)
+    """
+    ranges = valid_band_ranges(metadata)
+    n_bands = sum(stop - start for start, stop in ranges)
+    data_clean = np.empty(data.shape[:2] + (n_bands,),dtype=dtype)
+    no_data = metadata['data ignore value']
+    scale_factor = metadata['reflectance scale factor']
+    offset = 0
+    for start, stop in ranges:
+        _clean_into(data[:,:,start:stop],data_clean[:,:,offset:offset+stop-start],no_data,scale_factor)
+        offset += stop - start
+
+    metadata_clean = metadata.copy()
+    metadata_clean['wavelength'] = [metadata['wavelength'][i] for i in valid_band_indices(metadata)]
+    return data_clean, metadata_clean
+
+def parse_map_info(map_info):
+    """
+    parse_map_info splits a NEON Map_Info string (bytes or str), eg.
+    'UTM,  1.000,  1.000,  368000.00,  4307000.0,  1.0000000e+000,  1.0000000e+000,  18,  North, ...'
+    and returns the gdal-style geotransform (xMin, pixel width, 0, yMax, 0, -pixel height)
+    """
+    map_info = map_info.decode('utf-8') if isinstance(map_info,bytes) else str(map_info)
+    map_info_split = map_info.split(',')
+    return (float(map_info_split[3]),float(map_info_split[5]),0.,
+            float(map_info_split[4]),0.,-float(map_info_split[6]))
+
+class ReflectanceMetadata(object):
+    """
+    ReflectanceMetadata parses the metadata of a NEON AOP reflectance h5 file once and caches
+    the georeferencing, so per-point lookups (eg. plot or tarp coordinates) are O(1) and work
+    on scalars or arrays.
+    --------
+     Inputs:
+         refl: the h5py <site>/Reflectance group of an open reflectance file
+         sitename: site name (name of the top-level group); default None
+    --------
+     Attributes:
+         shape: (rows, columns, bands)
+         wavelengths: band center wavelengths (nm), numpy array
+         map_info: Map_Info string
+         geotransform: (xMin, pixel width, 0, yMax, 0, -pixel height)
+         res: (pixel width, pixel height) in meters
+         extent: (xMin, xMax, yMin, yMax) in meters
+         epsg: EPSG code (int)
+         no_data, scale_factor: Data_Ignore_Value and Scale_Factor (float)
+         bad_band_window1, bad_band_window2: water vapor band windows (nm)
+         valid_bands: indices of the bands kept after bad band removal (see valid_band_ranges)
+    --------
+    Usage:
+    --------
+    md = read_metadata('NEON_D02_SERC_DP3_368000_4306000_reflectance.h5')
+    row, col = md.world_to_pixel(368452.5,4306631.5)
+    rows, cols = md.world_to_pixel(plots['easting'].values,plots['northing'].values)
+    """
+    def __init__(self,refl,sitename=None):
+        reflData = refl['Reflectance_Data']
+        coordinate_system = refl['Metadata']['Coordinate_System']
+        self.sitename = sitename
+        self.shape = reflData.shape
+        self.wavelengths = refl['Metadata']['Spectral_Data']['Wavelength'][()]
+        map_info = coordinate_system['Map_Info'][()]
+        self.map_info = map_info.decode('utf-8') if isinstance(map_info,bytes) else str(map_info)
+        self.epsg = int(coordinate_system['EPSG Code'][()])
+        self.no_data = float(reflData.attrs['Data_Ignore_Value'])
+        self.scale_factor = float(reflData.attrs['Scale_Factor'])
+        self.spatial_extent = reflData.attrs['Spatial_Extent_meters'] if 'Spatial_Extent_meters' in reflData.attrs else None
+        self.interleave = reflData.attrs['Interleave'] if 'Interleave' in reflData.attrs else None
+        self.bad_band_window1 = refl.attrs['Band_Window_1_Nanometers']
+        self.bad_band_window2 = refl.attrs['Band_Window_2_Nanometers']
+
+        self.geotransform = parse_map_info(self.map_info)
+        self.res = (self.geotransform[1],-self.geotransform[5])
+        xMin, yMax = self.geotransform[0], self.geotransform[3]
+        self.extent = (xMin,xMin + self.shape[1]*self.res[0],yMax - self.shape[0]*self.res[1],yMax)
+        self.valid_bands = valid_band_indices({'wavelength':self.wavelengths,
+                                               'bad band window1':self.bad_band_window1,
+                                               'bad band window2':self.bad_band_window2})
+
+    def world_to_pixel(self,x,y):
+        """
+        world_to_pixel returns the (row, column) of the pixel containing UTM coordinates (x, y);
+        x and y can be scalars or arrays. Points outside the file give indices outside
+        [0, rows) / [0, columns), see contains.
+        """
+        col = np.floor((np.asarray(x) - self.extent[0])/self.res[0]).astype(int)
+        row = np.floor((self.extent[3] - np.asarray(y))/self.res[1]).astype(int)
+        if col.ndim == 0:
+            return int(row), int(col)
+        return row, col
+
+    def pixel_to_world(self,row,col):
+        # UTM coordinates (x, y) of the center of pixel (row, column); scalars or arrays
+        x = self.extent[0] + (np.asarray(col) + 0.5)*self.res[0]
+        y = self.extent[3] - (np.asarray(row) + 0.5)*self.res[1]
+        return x, y
+
+    def contains(self,x,y):
+        # True where the UTM coordinates (x, y) fall inside the file extent; scalars or arrays
+        x, y = np.asarray(x), np.asarray(y)
+        return (x >= self.extent[0]) & (x < self.extent[1]) & (y > self.extent[2]) & (y <= self.extent[3])
+
+    def as_dict(self):
+        """
+        as_dict returns a metadata dictionary with the keys used by aop_h5refl2array
+        (map info, wavelength, ..., epsg) and h5refl2array (shape, res, extent, ext_dict)
+        """
+        metadata = {}
+        metadata['map info'] = self.map_info
+        metadata['wavelength'] = self.wavelengths
+        metadata['data ignore value'] = self.no_data
+        metadata['reflectance scale factor'] = self.scale_factor
+        metadata['spatial extent'] = self.spatial_extent
+        metadata['bad band window1'] = self.bad_band_window1
+        metadata['bad band window2'] = self.bad_band_window2
+        metadata['epsg'] = self.epsg
+        if self.interleave is not None:
+            metadata['interleave'] = self.interleave
+        metadata['shape'] = self.shape
+        metadata['res'] = {'pixelWidth':self.res[0],'pixelHeight':self.res[1]}
+        metadata['extent'] = self.extent
+        metadata['ext_dict'] = dict(zip(('xMin','xMax','yMin','yMax'),self.extent))
+        return metadata
+
+def read_metadata(refl_filename):
+    # ReflectanceMetadata of a reflectance h5 file, without reading any reflectance data
+    with h5py.File(refl_filename,'r') as hdf5_file:
+        sitename = list(hdf5_file.keys())[0]
+        return ReflectanceMetadata(hdf5_file[sitename]['Reflectance'],sitename)
+
+class ReflectanceTile(object):
+    """
+    ReflectanceTile opens a NEON AOP reflectance hdf5 file (tile or flightline) and reads
+    spatial windows and band subsets of the reflectance data on request.
+    --------
+     Inputs:
+         refl_filename: full or relative path and name of reflectance hdf5 file
+    --------
+     Attributes:
+         shape: (rows, columns, bands) of Reflectance_Data
+         meta: ReflectanceMetadata, parsed once when the file is opened
+         wavelengths: band center wavelengths (nm), numpy array
+         geotransform: (xMin, pixel width, 0, yMax, 0, -pixel height) from Map_Info
+         metadata: dictionary with the same keys as aop_h5refl2array (map info, wavelength,
+                   data ignore value, reflectance scale factor, spatial extent, bad band window1,
+                   bad band window2, epsg, interleave) plus extent, ext_dict and res
+    --------
+    Usage:
+    --------
+    with ReflectanceTile('NEON_D02_SERC_DP3_368000_4306000_reflectance.h5') as tile:
+        red = tile.read_wavelength(648)                         # (1000, 1000) float32
+        subset = tile.read(window=((0,200),(0,200)),bands=range(0,100))
+        vnir = tile.read(bands=tile.bands_in_range(400,1000))
+    """
+    def __init__(self,refl_filename):
+        self.filename = refl_filename
+        self.hdf5_file = h5py.File(refl_filename,'r')
+        self.sitename = list(self.hdf5_file.keys())[0]
+        refl = self.hdf5_file[self.sitename]['Reflectance']
+        self.dataset = refl['Reflectance_Data']
+        self.shape = self.dataset.shape
+        self.meta = ReflectanceMetadata(refl,self.sitename)
+        self.metadata = self.meta.as_dict()
+        self.wavelengths = self.meta.wavelengths
+        self.no_data = self.meta.no_data
+        self.scale_factor = self.meta.scale_factor
+        self.geotransform = self.meta.geotransform
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self,*exc_info):
+        self.close()
+
+    def close(self):
+        self.hdf5_file.close()
+
+    def band_index(self,wavelength):
+        # index of the band with center wavelength closest to wavelength (nm)
+        return int(np.argmin(np.abs(self.wavelengths - wavelength)))
+
+    def bands_in_range(self,wavelength_min,wavelength_max):
+        # indices of the bands with center wavelengths between wavelength_min and wavelength_max (nm)
+        return np.flatnonzero((self.wavelengths >= wavelength_min) & (self.wavelengths <= wavelength_max))
+
+    def iter_windows(self,block_size=(256,256)):
+        """
+        iter_windows yields ((row_start,row_stop),(col_start,col_stop)) windows covering the
+        tile in blocks of block_size (rows, columns); edge blocks may be smaller
+        """
+        rows, cols = self.shape[0], self.shape[1]
+        for r0 in range(0,rows,block_size[0]):
+            for c0 in range(0,cols,block_size[1]):
+                yield (r0,min(r0+block_size[0],rows)), (c0,min(c0+block_size[1],cols))
+
+    def read_raw(self,window=None,bands=None):
+        """
+        read_raw reads a hyperslab of Reflectance_Data in its stored dtype (int16), without
+        applying the no data value or scale factor
+        --------
+         Inputs:
+             window: ((row_start,row_stop),(col_start,col_stop)); default None (all rows and columns)
+             bands: band index, slice, or list of band indices in any order; default None (all bands)
+        --------
+         Returns:
+             array of shape (rows, columns, bands), or (rows, columns) if bands is a single index
+        """
+        if window is None:
+            rows, cols = slice(None), slice(None)
+        else:
+            rows, cols = slice(*window[0]), slice(*window[1])
+        if bands is None:
+            return self.dataset[rows,cols,:]
+        if isinstance(bands,(int,np.integer,slice)):
+            return self.dataset[rows,cols,bands]
+        #h5py needs increasing, unique indices; read those and reorder to the requested band order
+        bands = np.asarray(bands,dtype=int)
+        unique_bands, order = np.unique(bands,return_inverse=True)
+        if len(unique_bands) > 1 and np.all(np.diff(unique_bands) == 1):
+            raw = self.dataset[rows,cols,unique_bands[0]:unique_bands[-1]+1]
+        else:
+            raw = self.dataset[rows,cols,list(unique_bands)]
+        if len(unique_bands) == len(bands) and np.all(order == np.arange(len(bands))):
+            return raw
+        return raw[:,:,order]
+
+    def read(self,window=None,bands=None,dtype=np.float32):
+        """
+        read reads a hyperslab of reflectance, sets the no data value to NaN and divides by the
+        reflectance scale factor. Only the requested window and bands are read from the file.
+        --------
+         Inputs:
+             window: ((row_start,row_stop),(col_start,col_stop)); default None (all rows and columns)
+             bands: band index, slice, or list of band indices; default None (all bands)
+             dtype: floating point dtype of the output; default np.float32
+        --------
+         Returns:
+             reflectance array of shape (rows, columns, bands), or (rows, columns) if bands is a
+             single index
+        """
+        raw = self.read_raw(window,bands)
+        refl = np.empty(raw.shape,dtype=dtype)
+        _clean_into(raw,refl,self.no_data,self.scale_factor)
+        return refl
+
+    def read_clean(self,window=None,dtype=np.float32):
+        """
+        read_clean reads a window of reflectance with the bad bands (see valid_band_ranges)
+        removed during the read: each valid band range is read from the file and scaled
+        directly into its slice of a single output array. Equivalent to
+        clean_neon_refl_data(read_neon_reflh5(...)) on the window, without reading the bad bands.
+        --------
+         Returns:
+             reflectance array of shape (rows, columns, valid bands); wavelengths of the
+             returned bands are self.wavelengths[self.meta.valid_bands]
+        """
+        ranges = valid_band_ranges(self.metadata)
+        n_bands = len(self.meta.valid_bands)
+        rows = (0,self.shape[0]) if window is None else window[0]
+        cols = (0,self.shape[1]) if window is None else window[1]
+        refl = np.empty((rows[1]-rows[0],cols[1]-cols[0],n_bands),dtype=dtype)
+        offset = 0
+        for start, stop in ranges:
+            _clean_into(self.read_raw(window,slice(start,stop)),refl[:,:,offset:offset+stop-start],
+                        self.no_data,self.scale_factor)
+            offset += stop - start
+        return refl
+
+    def read_band(self,band,window=None,dtype=np.float32):
+        # reflectance of a single band (index), shape (rows, columns)
+        return self.read(window,int(band),dtype)
+
+    def read_wavelength(self,wavelength,window=None,dtype=np.float32):
+        # reflectance of the band closest to wavelength (nm), shape (rows, columns)
+        return self.read_band(self.band_index(wavelength),window,dtype)
+
+    def read_wavelength_range(self,wavelength_min,wavelength_max,window=None,dtype=np.float32):
+        # reflectance of all bands between wavelength_min and wavelength_max (nm)
+        return self.read(window,self.bands_in_range(wavelength_min,wavelength_max),dtype)
+
+    def read_spectrum(self,row,col,dtype=np.float32):
+        # reflectance spectrum of a single pixel, shape (bands,)
+        return self.read(((row,row+1),(col,col+1)),None,dtype)[0,0,:]
+
+def repackage_reflectance(refl_filename,out_filename,layout='band',compression='gzip',compression_opts=4,
+                          block_rows=256):
+    """
+    repackage_reflectance copies a NEON AOP reflectance h5 file to a new h5 file whose
+    Reflectance_Data is chunked for the intended access pattern and compressed. The group
+    structure, Coordinate_System and Spectral_Data metadata (map info, EPSG, wavelengths) and
+    the reflectance attributes (scale factor, no data value, bad band windows, spatial extent)
+    are kept, so the new file is read with the same ReflectanceTile API. The data is copied
+    block_rows rows at a time, rounded up to whole chunk rows so each chunk is written once.
+    --------
+     Inputs:
+         refl_filename: NEON reflectance h5 filename
+         out_filename: output h5 filename
+         layout: 'band' (band-sequential chunks, for imagery / indices), 'spectral' (pixel-spectral
+                 chunks, for spectra), or a (rows, columns, bands) chunk shape; default 'band'
+         compression: h5py compression filter ('gzip', 'lzf', or None); default 'gzip'
+         compression_opts: gzip level; default 4
+         block_rows: number of rows copied at a time, rounded up to a multiple of the chunk
+                     rows; default 256
+    --------
+    Usage:
+    --------
+    repackage_reflectance('NEON_D02_SERC_DP3_368000_4306000_reflectance.h5','SERC_368000_4306000_bsq.h5','band')
+    with ReflectanceTile('SERC_368000_4306000_bsq.h5') as tile:
+        nir = tile.read_wavelength(860)   # reads only the chunks of one band
+    """
+    chunks = CHUNK_LAYOUTS[layout] if isinstance(layout,str) else tuple(layout)
+    with ReflectanceTile(refl_filename) as tile, h5py.File(out_filename,'w') as out_file:
+        rows, cols, bands = tile.shape
+        chunks = (min(chunks[0],rows),min(chunks[1],cols),bands if chunks[2] is None else min(chunks[2],bands))
+        #whole chunk rows per block: a partly written chunk would be compressed, evicted and rewritten
+        block_rows = -(-max(block_rows,1)//chunks[0])*chunks[0]
+        src_refl = tile.hdf5_file[tile.sitename]['Reflectance']
+        dst_refl = out_file.create_group(tile.sitename + '/Reflectance')
+        for key, value in src_refl.attrs.items():
+            dst_refl.attrs[key] = value
+        metadata = dst_refl.create_group('Metadata')
+        for group in ('Coordinate_System','Spectral_Data'):
+            src_refl.copy(src_refl['Metadata'][group],metadata,name=group)
+
+        shuffle = compression is not None
+        dataset = dst_refl.create_dataset('Reflectance_Data',shape=tile.shape,dtype=tile.dataset.dtype,
+                                          chunks=chunks,compression=compression,shuffle=shuffle,
+                                          compression_opts=compression_opts if compression == 'gzip' else None)
+        for key, value in tile.dataset.attrs.items():
+            dataset.attrs[key] = value
+        dataset.attrs['Chunk_Layout'] = layout if isinstance(layout,str) else 'custom'
+
+        for r0 in range(0,rows,block_rows):
+            window = ((r0,min(r0+block_rows,rows)),(0,cols))
+            dataset[window[0][0]:window[0][1],:,:] = tile.read_raw(window)
+    return out_filename
@@ -0,0 +1,166 @@
+# -*- coding: utf-8 -*-
+"""
+Spectral index engine for NEON AOP reflectance h5 tiles.
+
+The NDVI tutorial reads the full reflectance cube and then hardcodes sercRefl[:,:,57] and
+sercRefl[:,:,89]. Here each index is an expression of named bands given by wavelength; the
+bands are looked up in the h5 wavelength metadata, only the bands needed by the requested
+indices are read (one window at a time), all indices are evaluated from that single read
+(with numexpr when it is installed, so no intermediate arrays are made), and each index is
+written to a tiled, compressed GeoTIFF. Several tiles are processed in parallel.
+"""
+
+import os
+import numpy as np
+from concurrent.futures import ProcessPoolExecutor
+from osgeo import gdal, osr
+from neon_aop_hyperspectral import ReflectanceTile
+
+try:
+    import numexpr
+except ImportError:
+    numexpr = None
+
+#index name: (expression, {band name: center wavelength (nm)})
+INDICES = {
+    'NDVI': ('(nir - red)/(nir + red)', {'nir':860,'red':660}),
+    'EVI': ('2.5*(nir - red)/(nir + 6*red - 7.5*blue + 1)', {'nir':860,'red':660,'blue':480}),
+    'SAVI': ('1.5*(nir - red)/(nir + red + 0.5)', {'nir':860,'red':660}),
+    'NDWI': ('(nir - swir)/(nir + swir)', {'nir':860,'swir':1240}),
+    'NBR': ('(nir - swir2)/(nir + swir2)', {'nir':860,'swir2':2200}),
+    'PRI': ('(r531 - r570)/(r531 + r570)', {'r531':531,'r570':570}),
+    'NDRE': ('(nir - rededge)/(nir + rededge)', {'nir':790,'rededge':720}),
+}
+
+#tiled, compressed GeoTIFF creation options; PREDICTOR=3 is the floating point predictor
+GTIFF_OPTIONS = ['TILED=YES','BLOCKXSIZE=256','BLOCKYSIZE=256','COMPRESS=DEFLATE','PREDICTOR=3','BIGTIFF=IF_SAFER']
+
+def geotiff_options(dtype=gdal.GDT_Float32):
+    # GTIFF_OPTIONS with the predictor for a GDAL data type: 3 (floating point) for float
+    # rasters, 2 (horizontal differencing) for integer rasters, which reject PREDICTOR=3
+    predictor = 'PREDICTOR=3' if dtype in (gdal.GDT_Float32,gdal.GDT_Float64) else 'PREDICTOR=2'
+    return [predictor if option.startswith('PREDICTOR=') else option for option in GTIFF_OPTIONS]
+
+def index_band_map(tile,indices):
+    """
+    index_band_map returns {index name: {band name: band index}}, using for each band name
+    the band with center wavelength closest to the one requested
+    --------
+     Inputs:
+         tile: ReflectanceTile
+         indices: dictionary {index name: (expression, {band name: wavelength})}, eg. INDICES
+    """
+    return {name:{band_name:tile.band_index(wavelength) for band_name, wavelength in bands.items()}
+            for name, (expression, bands) in indices.items()}
+
+def evaluate_indices(band_arrays,indices,band_map):
+    """
+    evaluate_indices evaluates several index expressions on the same band arrays, with
+    numexpr if it is installed (one fused loop per index, no temporaries) or NumPy otherwise
+    --------
+     Inputs:
+         band_arrays: dictionary {band index: reflectance array}
+         indices: dictionary {index name: (expression, {band name: wavelength})}
+         band_map: dictionary {index name: {band name: band index}}, from index_band_map
+    --------
+     Returns:
+         dictionary {index name: float32 array}
+    """
+    results = {}
+    with np.errstate(invalid='ignore',divide='ignore'):
+        for name, (expression, bands) in indices.items():
+            local_dict = {band_name:band_arrays[band_index] for band_name, band_index in band_map[name].items()}
+            if numexpr is not None:
+                results[name] = numexpr.evaluate(expression,local_dict=local_dict).astype(np.float32,copy=False)
+            else:
+                results[name] = np.asarray(eval(expression,{'__builtins__':{}},local_dict),dtype=np.float32)
+    return results
+
+def calculate_indices(tile,indices=INDICES,window=None):
+    """
+    calculate_indices reads only the bands needed by the indices (each band once, even if
+    several indices use it) for a window of a ReflectanceTile and returns
+    {index name: float32 array (rows, columns)}
+    --------
+    Usage:
+    --------
+    with ReflectanceTile('NEON_D02_SERC_DP3_368000_4306000_reflectance.h5') as tile:
+        serc_indices = calculate_indices(tile,{k:INDICES[k] for k in ['NDVI','EVI']})
+    """
+    band_map = index_band_map(tile,indices)
+    band_indices = sorted(set(b for bands in band_map.values() for b in bands.values()))
+    refl = tile.read(window,band_indices)
+    band_arrays = {b:refl[:,:,i] for i, b in enumerate(band_indices)}
+    return evaluate_indices(band_arrays,indices,band_map)
+
+def create_geotiff(filename,tile,bands=1,dtype=gdal.GDT_Float32,options=None):
+    # create an empty tiled GeoTIFF with the size, geotransform and EPSG of a ReflectanceTile;
+    # options default to geotiff_options(dtype)
+    if options is None:
+        options = geotiff_options(dtype)
+    driver = gdal.GetDriverByName('GTiff')
+    dataset = driver.Create(filename,tile.shape[1],tile.shape[0],bands,dtype,options)
+    dataset.SetGeoTransform(tile.geotransform)
+    srs = osr.SpatialReference()
+    srs.ImportFromEPSG(tile.metadata['epsg'])
+    dataset.SetProjection(srs.ExportToWkt())
+    return dataset
+
+def write_indices(refl_filename,out_dir,indices=INDICES,block_size=(256,256)):
+    """
+    write_indices calculates the indices for a reflectance h5 file one window at a time and
+    writes each index to out_dir/<file name>_<index name>.tif (tiled, DEFLATE compressed)
+    --------
+     Inputs:
+         refl_filename: reflectance h5 filename
+         out_dir: folder for the index GeoTIFFs
+         indices: dictionary {index name: (expression, {band name: wavelength})}; default INDICES
+         block_size: (rows, columns) of the windows read at a time; default (256,256), which
+                     matches the GeoTIFF tiles
+    --------
+     Returns:
+         dictionary {index name: GeoTIFF filename}
+    """
+    if not os.path.exists(out_dir):
+        os.makedirs(out_dir,exist_ok=True)
+    basename = os.path.basename(refl_filename).replace('_reflectance.h5','').replace('.h5','')
+    filenames = {name:os.path.join(out_dir,basename + '_' + name + '.tif') for name in indices}
+    with ReflectanceTile(refl_filename) as tile:
+        datasets = {name:create_geotiff(filenames[name],tile) for name in indices}
+        for name in indices:
+            datasets[name].GetRasterBand(1).SetNoDataValue(np.nan)
+        for window in tile.iter_windows(block_size):
+            for name, array in calculate_indices(tile,indices,window).items():
+                datasets[name].GetRasterBand(1).WriteArray(array,window[1][0],window[0][0])
+        for name in indices:
+            datasets[name].FlushCache()
+            datasets[name] = None
+    return filenames
+
+def _write_indices_args(args):
+    return write_indices(*args)
+
+def write_indices_files(refl_filenames,out_dir,indices=INDICES,block_size=(256,256),max_workers=None):
+    """
+    write_indices_files runs write_indices on a list of reflectance h5 files (eg. all tiles of
+    a site) in parallel with a process pool
+    --------
+     Inputs:
+         refl_filenames: list of reflectance h5 filenames
+         out_dir: folder for the index GeoTIFFs
+         indices: dictionary {index name: (expression, {band name: wavelength})}; default INDICES
+         block_size: (rows, columns) of the windows read at a time; default (256,256)
+         max_workers: number of processes; default None (number of CPUs)
+    --------
+     Returns:
+         list of {index name: GeoTIFF filename}, in the order of refl_filenames
+    --------
+    Usage:
+    --------
+    import glob
+    tiles = glob.glob('./data/SERC_2019/*_reflectance.h5')
+    write_indices_files(tiles,'./data/SERC_2019/indices',{k:INDICES[k] for k in ['NDVI','NBR','PRI']})
+    """
+    args = [(refl_filename,out_dir,indices,block_size) for refl_filename in refl_filenames]
+    with ProcessPoolExecutor(max_workers=max_workers) as executor:
+        return list(executor.map(_write_indices_args,args))
@@ -0,0 +1,162 @@
+# -*- coding: utf-8 -*-
+"""
+Apply a fitted scikit-learn model (eg. the SVC or LinearRegression of Classification_Scikit_SVM_py
+and Classification_OLS_py) to NEON AOP reflectance tiles.
+
+The tutorials fit and predict on in-memory .mat matrices. Here windows of a reflectance h5 file
+are read by a process pool, reshaped to (pixels x bands), passed through predict and
+decision_function in bounded batches, and written to a class raster and a score raster. The
+model is sent once to each worker (pool initializer) instead of with every window.
+"""
+
+import time
+import numpy as np
+from concurrent.futures import ProcessPoolExecutor
+from neon_aop_hyperspectral import ReflectanceTile
+
+#pixels passed to the model at a time
+BATCH_SIZE = 16384
+
+_worker_model = None
+
+def _init_worker(model):
+    global _worker_model
+    _worker_model = model
+
+def predict_pixels(model,pixels,batch_size=BATCH_SIZE,scores=True):
+    """
+    predict_pixels runs model.predict (and model.decision_function if scores=True and the model
+    has one) on a (pixels x bands) array in batches of batch_size; rows with NaN are skipped
+    --------
+     Returns:
+         predictions (pixels,) as returned by model.predict (float predictions are NaN for
+         skipped rows); and scores (pixels,) or (pixels, n_classes) float32, or None
+    """
+    valid = np.flatnonzero(~np.isnan(pixels).any(axis=1))
+    predictions = None
+    decision = None
+    for start in range(0,len(valid),batch_size):
+        rows = valid[start:start+batch_size]
+        batch = pixels[rows]
+        p = model.predict(batch)
+        if predictions is None:
+            predictions = np.empty(len(pixels),dtype=np.float64 if p.dtype.kind == 'f' else p.dtype)
+            if predictions.dtype.kind == 'f':
+                predictions[:] = np.nan
+        predictions[rows] = np.ravel(p)
+        if scores and hasattr(model,'decision_function'):
+            d = np.asarray(model.decision_function(batch),dtype=np.float32)
+            if decision is None:
+                decision = np.full((len(pixels),) + d.shape[1:],np.nan,dtype=np.float32)
+            decision[rows] = d
+    if predictions is None:
+        predictions = np.full(len(pixels),np.nan)
+    return predictions, decision
+
+def _class_codes(model,predictions,valid):
+    # classifiers: 1..n_classes in the order of model.classes_, 0 for no data; uint16 above 255 classes
+    codes = np.zeros(len(predictions),dtype=np.uint8 if len(model.classes_) < 256 else np.uint16)
+    codes[valid] = np.searchsorted(model.classes_,predictions[valid]) + 1
+    return codes
+
+def _infer_window(args):
+    # worker: read one window and run the model; returns window, class/prediction block, score block, n pixels
+    refl_filename, window, bands, batch_size, scores = args
+    with ReflectanceTile(refl_filename) as tile:
+        refl = tile.read_clean(window) if bands is None else tile.read(window,bands)
+    shape = refl.shape[:2]
+    pixels = refl.reshape(-1,refl.shape[2])
+    valid = ~np.isnan(pixels).any(axis=1)
+    predictions, decision = predict_pixels(_worker_model,pixels,batch_size,scores)
+    if hasattr(_worker_model,'classes_'):
+        predictions = _class_codes(_worker_model,predictions,valid)
+    else:
+        predictions = predictions.astype(np.float32)
+    if decision is not None:
+        decision = decision.reshape(shape + (-1,))
+    return window, predictions.reshape(shape), decision, int(valid.sum())
+
+def classify_file(model,refl_filename,class_filename,score_filename=None,wavelengths=None,
+                  block_size=(256,256),batch_size=BATCH_SIZE,max_workers=None):
+    """
+    classify_file applies a fitted model to every window of a reflectance h5 file in parallel
+    --------
+     Inputs:
+         model: fitted scikit-learn classifier or regressor (must be picklable)
+         refl_filename: reflectance h5 filename
+         class_filename: GeoTIFF of the predictions; for classifiers uint8 codes 1..n_classes
+                         in the order of model.classes_ (0 is no data; uint16 above 255
+                         classes), for regressors float32
+         score_filename: GeoTIFF of decision_function (one band, or one band per class);
+                         default None (not computed)
+         wavelengths: wavelengths (nm) of the model features, each matched to the closest band;
+                      default None (all bands with the bad bands removed, as read_clean)
+         block_size: (rows, columns) of the windows; default (256,256)
+         batch_size: pixels per predict call; default BATCH_SIZE
+         max_workers: number of processes; default None (number of CPUs)
+    --------
+     Returns:
+         dictionary with the class/score filenames, number of valid pixels, seconds and pixels per second
+    --------
+    Usage:
+    --------
+    summary = classify_file(TrainedSVM,'NEON_D03_OSBS_DP3_403000_3285000_reflectance.h5',
+                            'OSBS_pines_oaks.tif','OSBS_pines_oaks_score.tif',wavelengths=np.ravel(Wv))
+    print(summary['pixels_per_second'])
+    """
+    from osgeo import gdal
+    from neon_aop_indices import create_geotiff
+    start_time = time.time()
+    is_classifier = hasattr(model,'classes_')
+    with ReflectanceTile(refl_filename) as tile:
+        bands = None if wavelengths is None else [tile.band_index(w) for w in wavelengths]
+        windows = list(tile.iter_windows(block_size))
+        if not is_classifier:
+            class_type = gdal.GDT_Float32
+        else:
+            class_type = gdal.GDT_Byte if len(model.classes_) < 256 else gdal.GDT_UInt16
+        class_dataset = create_geotiff(class_filename,tile,1,class_type)
+        score_dataset = None
+        if score_filename is not None and hasattr(model,'decision_function'):
+            n_scores = len(model.classes_) if is_classifier and len(model.classes_) > 2 else 1
+            score_dataset = create_geotiff(score_filename,tile,n_scores)
+    class_dataset.GetRasterBand(1).SetNoDataValue(0 if is_classifier else np.nan)
+
+    n_pixels = 0
+    args = [(refl_filename,window,bands,batch_size,score_dataset is not None) for window in windows]
+    with ProcessPoolExecutor(max_workers=max_workers,initializer=_init_worker,initargs=(model,)) as executor:
+        for window, predictions, decision, n_valid in executor.map(_infer_window,args):
+            class_dataset.GetRasterBand(1).WriteArray(predictions,window[1][0],window[0][0])
+            if score_dataset is not None and decision is not None:
+                for band in range(decision.shape[2]):
+                    score_dataset.GetRasterBand(band+1).WriteArray(decision[:,:,band],window[1][0],window[0][0])
+            n_pixels += n_valid
+    for dataset in (class_dataset,score_dataset):
+        if dataset is not None:
+            dataset.FlushCache()
+    class_dataset = score_dataset = None
+    seconds = time.time() - start_time
+    return {'class_filename':class_filename,'score_filename':score_filename,'pixels':n_pixels,
+            'seconds':seconds,'pixels_per_second':n_pixels/seconds if seconds > 0 else float('nan')}
+
+def benchmark_inference(model,n_features,n_pixels=100000,batch_sizes=(1024,4096,16384,65536),seed=0):
+    """
+    benchmark_inference times predict and decision_function of a fitted model on random
+    (n_pixels x n_features) reflectance-like data for several batch sizes and prints pixels per second
+    --------
+     Returns:
+         dictionary {batch size: pixels per second}
+    --------
+    Usage:
+    --------
+    benchmark_inference(TrainedSVM,TrainSet.shape[1])
+    """
+    rng = np.random.default_rng(seed)
+    pixels = rng.uniform(0,0.6,(n_pixels,n_features))
+    results = {}
+    for batch_size in batch_sizes:
+        start_time = time.time()
+        predict_pixels(model,pixels,batch_size)
+        results[batch_size] = n_pixels/(time.time() - start_time)
+        print('batch size {0:6d}: {1:12.0f} pixels/s'.format(batch_size,results[batch_size]))
+    return results
@@ -0,0 +1,133 @@
+# -*- coding: utf-8 -*-
+"""
+Approximate RBF kernel SVM for large sets of labeled spectra.
+
+Classification_Scikit_SVM_py trains sklearn.svm.SVC(), whose training time grows roughly with
+the square of the number of spectra. Here spectra are mapped to an explicit feature space that
+approximates the same RBF kernel, either random Fourier features (RBFSampler) or a Nystroem
+approximation, and a linear SVM (hinge loss) is trained with stochastic gradient descent, so
+training time grows linearly with the number of spectra. The fitted pipelines have predict,
+decision_function and classes_, so they can be used with neon_aop_inference.classify_file.
+
+compare_tutorial_datasets times and scores these models against SVC() on the .mat datasets of
+the tutorial (LinSepC1/LinSepC2 and Pines/Oaks).
+"""
+
+import os, time
+import numpy as np
+from scipy import io
+
+def rbf_gamma(X):
+    # gamma='scale' of sklearn.svm.SVC: 1/(n_features*X.var())
+    return 1.0/(X.shape[1]*X.var())
+
+def fit_approximate_svm(X,y,method='rff',n_components=500,gamma='scale',alpha=1e-4,max_iter=50,seed=0):
+    """
+    fit_approximate_svm fits a linear SVM trained with SGD on an approximate RBF kernel map
+    --------
+     Inputs:
+         X: (spectra x bands) training spectra
+         y: (spectra,) class labels
+         method: 'rff' (random Fourier features) or 'nystroem'; default 'rff'
+         n_components: dimension of the kernel map; default 500
+         gamma: RBF kernel width, or 'scale' for the SVC() default; default 'scale'
+         alpha: SGD regularization (comparable to 1/(C*n_spectra) of SVC); default 1e-4
+         max_iter: SGD passes over the training data; default 50
+         seed: random seed; default 0
+    --------
+     Returns:
+         fitted sklearn Pipeline (kernel map, SGDClassifier)
+    --------
+    Usage:
+    --------
+    FastSVM = fit_approximate_svm(TrainSet,Targets,'nystroem')
+    dtest = FastSVM.decision_function(TestSet)
+    """
+    from sklearn.kernel_approximation import Nystroem, RBFSampler
+    from sklearn.linear_model import SGDClassifier
+    from sklearn.pipeline import make_pipeline
+    X = np.asarray(X,dtype=np.float64)
+    if gamma == 'scale':
+        gamma = rbf_gamma(X)
+    if method == 'rff':
+        kernel_map = RBFSampler(gamma=gamma,n_components=n_components,random_state=seed)
+    elif method == 'nystroem':
+        kernel_map = Nystroem(gamma=gamma,n_components=min(n_components,len(X)),random_state=seed)
+    else:
+        raise ValueError("method must be 'rff' or 'nystroem', not " + repr(method))
+    classifier = SGDClassifier(loss='hinge',alpha=alpha,max_iter=max_iter,tol=1e-4,random_state=seed)
+    return make_pipeline(kernel_map,classifier).fit(X,np.ravel(y))
+
+def load_tutorial_datasets(data_dir):
+    """
+    load_tutorial_datasets loads the .mat files of the SVM tutorial from data_dir and returns
+    {dataset name: (X_train, y_train, X_test, y_test)}, with classes -1 and 1 as in the tutorial:
+    LinSep (all 400 LinSepC1/LinSepC2 samples used for training and testing, as in the tutorial)
+    and PinesOaks (first 600 spectra of each class for training, next 200 for testing)
+    """
+    datasets = {}
+    if os.path.exists(os.path.join(data_dir,'LinSepC1.mat')):
+        C1 = io.loadmat(os.path.join(data_dir,'LinSepC1.mat'))['LinSepC1']
+        C2 = io.loadmat(os.path.join(data_dir,'LinSepC2.mat'))['LinSepC2']
+        X = np.concatenate((C1,C2),axis=0)
+        y = np.concatenate((np.ones(len(C1)),-np.ones(len(C2))))
+        datasets['LinSep'] = (X,y,X,y)
+    if os.path.exists(os.path.join(data_dir,'Pines.mat')):
+        Pines = io.loadmat(os.path.join(data_dir,'Pines.mat'))['Pines']
+        Oaks = io.loadmat(os.path.join(data_dir,'Oaks.mat'))['Oaks']
+        X_train = np.concatenate((Pines[0:600],Oaks[0:600]),axis=0)
+        X_test = np.concatenate((Pines[600:800],Oaks[600:800]),axis=0)
+        y_train = np.concatenate((-np.ones(600),np.ones(600)))
+        y_test = np.concatenate((-np.ones(len(Pines[600:800])),np.ones(len(Oaks[600:800]))))
+        datasets['PinesOaks'] = (X_train,y_train,X_test,y_test)
+    return datasets
+
+def compare_with_svc(X_train,y_train,X_test,y_test,methods=('rff','nystroem'),n_components=500,**svm_args):
+    """
+    compare_with_svc trains SVC() and the approximate SVMs on the same data and returns
+    {model name: {'fit_seconds','predict_seconds','train_accuracy','test_accuracy'}}
+    """
+    from sklearn.svm import SVC
+    models = {'SVC':lambda: SVC().fit(X_train,np.ravel(y_train))}
+    for method in methods:
+        models[method] = lambda method=method: fit_approximate_svm(X_train,y_train,method,n_components,**svm_args)
+    results = {}
+    for name, fit in models.items():
+        start_time = time.time()
+        model = fit()
+        fit_seconds = time.time() - start_time
+        start_time = time.time()
+        test_predictions = model.predict(X_test)
+        predict_seconds = time.time() - start_time
+        results[name] = {'fit_seconds':fit_seconds,'predict_seconds':predict_seconds,
+                         'train_accuracy':np.mean(model.predict(X_train) == np.ravel(y_train)),
+                         'test_accuracy':np.mean(test_predictions == np.ravel(y_test))}
+    return results
+
+def print_comparison(results,title=''):
+    print(title)
+    print('{0:10s} {1:>10s} {2:>12s} {3:>10s} {4:>10s}'.format('model','fit (s)','predict (s)','train acc','test acc'))
+    for name, r in results.items():
+        print('{0:10s} {1:10.4f} {2:12.4f} {3:10.3f} {4:10.3f}'.format(
+            name,r['fit_seconds'],r['predict_seconds'],r['train_accuracy'],r['test_accuracy']))
+
+def compare_tutorial_datasets(data_dir,replicate=(1,),**compare_args):
+    """
+    compare_tutorial_datasets runs compare_with_svc on each tutorial dataset found in data_dir.
+    replicate lists factors by which the training set is repeated with small noise added,
+    to show how fit time grows with the number of spectra for SVC and the approximations.
+    --------
+    Usage:
+    --------
+    compare_tutorial_datasets('/Users/olearyd/Git/data/RSDI2017-Data-SpecClass/',replicate=(1,4,16))
+    """
+    rng = np.random.default_rng(0)
+    all_results = {}
+    for dataset, (X_train,y_train,X_test,y_test) in load_tutorial_datasets(data_dir).items():
+        for factor in replicate:
+            X = np.concatenate([X_train] + [X_train + rng.normal(0,0.005,X_train.shape) for i in range(factor-1)])
+            y = np.tile(y_train,factor)
+            results = compare_with_svc(X,y,X_test,y_test,**compare_args)
+            print_comparison(results,'{0} ({1} training spectra)'.format(dataset,len(X)))
+            all_results[(dataset,factor)] = results
+    return all_results
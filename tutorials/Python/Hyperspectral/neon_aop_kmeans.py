@@ -0,0 +1,174 @@
+# -*- coding: utf-8 -*-
+"""
+Mini-batch k-means classification of NEON AOP reflectance tiles.
+
+classification_kmeans_pca runs spectral.kmeans(img_subset,5,50) on a 200 x 200 subset because
+every iteration visits every pixel. Here the centroids are initialized with k-means++ and fit on
+a stream of random pixel samples read window by window with ReflectanceTile (mini-batch k-means,
+Sculley 2010). All blocks of a tile are then labeled in parallel and written to a class GeoTIFF.
+The fitted model can be saved and reused on other tiles or years with the same bands.
+
+Class rasters use 1..k for the clusters and 0 for no data.
+"""
+
+import numpy as np
+from concurrent.futures import ProcessPoolExecutor
+from neon_aop_hyperspectral import ReflectanceTile
+
+def assign_labels(pixels,centers,chunk_size=4096):
+    """
+    assign_labels returns the index (0..k-1) of the closest center for each row of a
+    (pixels x bands) array, and the squared distance to it; chunks of pixels are evaluated
+    with ||x||^2 - 2 x.c + ||c||^2
+    """
+    centers = np.asarray(centers,dtype=np.float32)
+    center_norms = np.einsum('ij,ij->i',centers,centers)
+    labels = np.empty(len(pixels),dtype=np.intp)
+    distances = np.empty(len(pixels),dtype=np.float32)
+    for start in range(0,len(pixels),chunk_size):
+        chunk = np.asarray(pixels[start:start+chunk_size],dtype=np.float32)
+        d = center_norms[None,:] - 2*chunk.dot(centers.T)
+        labels[start:start+chunk_size] = np.argmin(d,axis=1)
+        distances[start:start+chunk_size] = np.maximum(d.min(axis=1) + np.einsum('ij,ij->i',chunk,chunk),0)
+    return labels, distances
+
+def kmeans_plusplus(pixels,k,seed=0):
+    """
+    kmeans_plusplus picks k initial centers from a (pixels x bands) sample, each one with
+    probability proportional to its squared distance to the closest center already chosen
+    """
+    rng = np.random.default_rng(seed)
+    pixels = np.asarray(pixels,dtype=np.float32)
+    centers = [pixels[rng.integers(len(pixels))]]
+    distances = assign_labels(pixels,centers)[1]
+    for i in range(1,k):
+        total = distances.sum()
+        index = rng.choice(len(pixels),p=distances/total) if total > 0 else rng.integers(len(pixels))
+        centers.append(pixels[index])
+        distances = np.minimum(distances,assign_labels(pixels,centers[-1:])[1])
+    return np.array(centers)
+
+def iter_pixel_samples(refl_filenames,batch_size=4096,n_batches=100,block_size=(256,256),seed=0):
+    """
+    iter_pixel_samples yields n_batches (batch_size x bands) arrays of valid (no NaN), bad band
+    removed pixels, each one sampled from a random window of a random file; windows with no
+    valid pixels are dropped, and ValueError is raised if no window has any
+    """
+    if isinstance(refl_filenames,str):
+        refl_filenames = [refl_filenames]
+    rng = np.random.default_rng(seed)
+    tiles = [ReflectanceTile(refl_filename) for refl_filename in refl_filenames]
+    try:
+        windows = [(tile,window) for tile in tiles for window in tile.iter_windows(block_size)]
+        yielded = 0
+        while yielded < n_batches:
+            if not windows:
+                raise ValueError('no valid pixels in ' + ', '.join(refl_filenames))
+            index = rng.integers(len(windows))
+            tile, window = windows[index]
+            refl = tile.read_clean(window)
+            pixels = refl.reshape(-1,refl.shape[2])
+            pixels = pixels[~np.isnan(pixels).any(axis=1)]
+            if len(pixels) == 0:
+                #window is all no data: never sample it again
+                windows.pop(index)
+                continue
+            yield pixels[rng.choice(len(pixels),min(batch_size,len(pixels)),replace=False)]
+            yielded += 1
+    finally:
+        for tile in tiles:
+            tile.close()
+
+class MiniBatchKMeans(object):
+    """
+    MiniBatchKMeans fits k-means centroids on a stream of pixel batches; each batch moves the
+    centers towards the mean of their assigned pixels with a per-center learning rate 1/count
+    --------
+     Inputs:
+         n_clusters: number of clusters
+         seed: random seed of the k-means++ initialization; default 0
+    --------
+    Usage:
+    --------
+    model = MiniBatchKMeans(5).fit(iter_pixel_samples(tiles,n_batches=200))
+    model.save('SERC_kmeans5.npz')
+    model = MiniBatchKMeans.load('SERC_kmeans5.npz')
+    classify_file(model,'NEON_D02_SERC_DP3_368000_4306000_reflectance.h5','SERC_kmeans5.tif')
+    """
+    def __init__(self,n_clusters,seed=0):
+        self.n_clusters = n_clusters
+        self.seed = seed
+        self.centers = None
+        self.counts = np.zeros(n_clusters,dtype=np.int64)
+
+    def partial_fit(self,pixels):
+        # update the centers with one (pixels x bands) batch; the first batch initializes them
+        pixels = np.asarray(pixels,dtype=np.float32)
+        if self.centers is None:
+            self.centers = kmeans_plusplus(pixels,self.n_clusters,self.seed).astype(np.float64)
+        labels = assign_labels(pixels,self.centers)[0]
+        batch_counts = np.bincount(labels,minlength=self.n_clusters)
+        batch_sums = np.zeros_like(self.centers)
+        np.add.at(batch_sums,labels,pixels)
+        self.counts += batch_counts
+        updated = batch_counts > 0
+        rate = batch_counts[updated]/self.counts[updated]
+        batch_means = batch_sums[updated]/batch_counts[updated,None]
+        self.centers[updated] += rate[:,None]*(batch_means - self.centers[updated])
+        return self
+
+    def fit(self,batches):
+        # fit on an iterable of (pixels x bands) batches, eg. iter_pixel_samples
+        for pixels in batches:
+            self.partial_fit(pixels)
+        return self
+
+    def predict(self,block):
+        """
+        predict returns the class (1..k, 0 for pixels with NaN) of each pixel of a
+        (..., bands) block as uint8, or uint16 if k > 255
+        """
+        pixels = block.reshape(-1,block.shape[-1])
+        valid = ~np.isnan(pixels).any(axis=1)
+        labels = np.zeros(len(pixels),dtype=np.uint8 if len(self.centers) < 256 else np.uint16)
+        labels[valid] = assign_labels(pixels[valid],self.centers)[0] + 1
+        return labels.reshape(block.shape[:-1])
+
+    def save(self,filename):
+        np.savez(filename,centers=self.centers,counts=self.counts,seed=self.seed)
+
+    @classmethod
+    def load(cls,filename):
+        saved = np.load(filename)
+        model = cls(len(saved['centers']),int(saved['seed']))
+        model.centers, model.counts = saved['centers'], saved['counts']
+        return model
+
+def _predict_block(args):
+    # worker: read and label one window of a reflectance h5 file
+    refl_filename, centers, window = args
+    model = MiniBatchKMeans(len(centers))
+    model.centers = centers
+    with ReflectanceTile(refl_filename) as tile:
+        return window, model.predict(tile.read_clean(window))
+
+def classify_file(model,refl_filename,out_filename,block_size=(256,256),max_workers=None):
+    """
+    classify_file labels all windows of a reflectance h5 file in parallel with a process pool
+    and writes the class raster (1..k, 0 no data; Byte, or UInt16 if k > 255) to a tiled GeoTIFF
+    """
+    from osgeo import gdal
+    from neon_aop_indices import create_geotiff
+    with ReflectanceTile(refl_filename) as tile:
+        windows = list(tile.iter_windows(block_size))
+        dataset = create_geotiff(out_filename,tile,1,gdal.GDT_Byte if len(model.centers) < 256 else gdal.GDT_UInt16,
+                                 ['TILED=YES','BLOCKXSIZE=256','BLOCKYSIZE=256','COMPRESS=DEFLATE'])
+    band = dataset.GetRasterBand(1)
+    band.SetNoDataValue(0)
+    args = [(refl_filename,model.centers,window) for window in windows]
+    with ProcessPoolExecutor(max_workers=max_workers) as executor:
+        for window, labels in executor.map(_predict_block,args):
+            band.WriteArray(labels,window[1][0],window[0][0])
+    dataset.FlushCache()
+    dataset = None
+    return out_filename
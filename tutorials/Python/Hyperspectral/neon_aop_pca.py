@@ -0,0 +1,197 @@
+# -*- coding: utf-8 -*-
+"""
+Out-of-core principal component (PCA) and minimum noise fraction (MNF) transforms for NEON AOP
+reflectance.
+
+Classification_PCA_py centers TinyVecs one sample at a time, normalizes it with a double loop and
+calls np.cov on the whole (bands x pixels) matrix, which only works for the small .mat subset.
+Here the mean and covariance are accumulated in a single pass over windows of reflectance files:
+each window's mean and scatter matrix are merged into the running totals with the pairwise
+update of Chan et al., so accumulators from different windows, files or processes can be merged
+in any order. The fitted transform then projects files back block by block.
+"""
+
+import numpy as np
+from concurrent.futures import ProcessPoolExecutor
+from neon_aop_hyperspectral import ReflectanceTile
+
+class CovarianceAccumulator(object):
+    """
+    CovarianceAccumulator accumulates the mean and covariance of spectra over blocks of pixels.
+    For MNF it also accumulates the covariance of the noise, estimated from the difference of
+    horizontally adjacent pixels (shift difference).
+    --------
+     Inputs:
+         n_bands: number of bands
+         noise: also accumulate the shift-difference noise covariance; default False
+    --------
+    Usage:
+    --------
+    acc = CovarianceAccumulator(360)
+    for refl_block in blocks:
+        acc.update(refl_block)
+    C = acc.covariance()
+    """
+    def __init__(self,n_bands,noise=False):
+        self.n_bands = n_bands
+        self.count = 0
+        self.mean = np.zeros(n_bands)
+        self.scatter = np.zeros((n_bands,n_bands))
+        self.noise = CovarianceAccumulator(n_bands) if noise else None
+
+    def _merge_moments(self,count,mean,scatter):
+        # Chan et al. pairwise update of (count, mean, sum of centered outer products)
+        if count == 0:
+            return
+        total = self.count + count
+        delta = mean - self.mean
+        self.scatter += scatter + np.outer(delta,delta)*(self.count*count/total)
+        self.mean += delta*(count/total)
+        self.count = total
+
+    def update(self,block):
+        """
+        update adds a (rows, columns, bands) or (pixels, bands) block; pixels with any NaN band are skipped
+        """
+        if self.noise is not None and block.ndim == 3:
+            diff = (block[:,1:] - block[:,:-1]).reshape(-1,self.n_bands)
+            self.noise.update(diff/np.sqrt(2))
+        pixels = block.reshape(-1,self.n_bands)
+        pixels = pixels[~np.isnan(pixels).any(axis=1)].astype(np.float64)
+        if len(pixels) == 0:
+            return
+        mean = pixels.mean(axis=0)
+        centered = pixels - mean
+        self._merge_moments(len(pixels),mean,centered.T.dot(centered))
+
+    def merge(self,other):
+        """
+        merge adds the statistics of another CovarianceAccumulator (eg. from another process)
+        """
+        self._merge_moments(other.count,other.mean,other.scatter)
+        if self.noise is not None and other.noise is not None:
+            self.noise.merge(other.noise)
+        return self
+
+    def covariance(self):
+        # sample covariance (same normalization as np.cov)
+        return self.scatter/(self.count - 1)
+
+class SpectralTransform(object):
+    """
+    SpectralTransform is a fitted PCA or MNF transform: components are projected as
+    (pixels - mean).dot(vectors), ordered by decreasing eigenvalue (variance for PCA,
+    signal to noise ratio for MNF)
+    --------
+     Attributes:
+         mean: mean spectrum (bands,)
+         vectors: (bands, components) projection matrix
+         eigenvalues: (components,)
+    """
+    def __init__(self,mean,vectors,eigenvalues):
+        self.mean = mean
+        self.vectors = vectors
+        self.eigenvalues = eigenvalues
+
+    @classmethod
+    def pca(cls,accumulator):
+        eigenvalues, vectors = np.linalg.eigh(accumulator.covariance())
+        order = np.argsort(eigenvalues)[::-1]
+        return cls(accumulator.mean,vectors[:,order],eigenvalues[order])
+
+    @classmethod
+    def mnf(cls,accumulator):
+        # whiten the noise covariance, then PCA of the whitened signal covariance
+        from scipy import linalg
+        eigenvalues, vectors = linalg.eigh(accumulator.covariance(),accumulator.noise.covariance())
+        order = np.argsort(eigenvalues)[::-1]
+        return cls(accumulator.mean,vectors[:,order],eigenvalues[order])
+
+    def explained_variance_ratio(self):
+        return self.eigenvalues/self.eigenvalues.sum()
+
+    def transform(self,block,n_components=None,dtype=np.float32):
+        """
+        transform projects a (..., bands) block onto the first n_components components;
+        NaN pixels stay NaN
+        """
+        vectors = self.vectors if n_components is None else self.vectors[:,:n_components]
+        pixels = block.reshape(-1,block.shape[-1])
+        return ((pixels - self.mean).dot(vectors)).astype(dtype).reshape(block.shape[:-1] + (vectors.shape[1],))
+
+    def inverse_transform(self,components):
+        # reconstruct spectra from (..., n_components) component values
+        n = components.shape[-1]
+        return components.dot(np.linalg.pinv(self.vectors)[:n]) + self.mean
+
+def accumulate_file(refl_filename,noise=False,block_size=(256,256)):
+    """
+    accumulate_file returns a CovarianceAccumulator of the (bad band removed) spectra of a
+    reflectance h5 file, read one window at a time
+    """
+    with ReflectanceTile(refl_filename) as tile:
+        accumulator = None
+        for window in tile.iter_windows(block_size):
+            refl = tile.read_clean(window)
+            if accumulator is None:
+                accumulator = CovarianceAccumulator(refl.shape[2],noise)
+            accumulator.update(refl)
+    return accumulator
+
+def _accumulate_file_args(args):
+    return accumulate_file(*args)
+
+def accumulate_files(refl_filenames,noise=False,block_size=(256,256),max_workers=None):
+    """
+    accumulate_files accumulates the statistics of several reflectance h5 files (eg. all tiles of
+    a site) in parallel with a process pool, merging the per-file accumulators
+    """
+    if isinstance(refl_filenames,str):
+        refl_filenames = [refl_filenames]
+    args = [(refl_filename,noise,block_size) for refl_filename in refl_filenames]
+    with ProcessPoolExecutor(max_workers=max_workers) as executor:
+        accumulators = list(executor.map(_accumulate_file_args,args))
+    total = accumulators[0]
+    for accumulator in accumulators[1:]:
+        total.merge(accumulator)
+    return total
+
+def fit_pca(refl_filenames,block_size=(256,256),max_workers=None):
+    """
+    fit_pca fits a PCA on all pixels of one or more reflectance h5 files in a single pass
+    --------
+    Usage:
+    --------
+    pca = fit_pca(glob.glob('./data/SERC_2019/*_reflectance.h5'))
+    print(pca.explained_variance_ratio()[:10])
+    """
+    return SpectralTransform.pca(accumulate_files(refl_filenames,False,block_size,max_workers))
+
+def fit_mnf(refl_filenames,block_size=(256,256),max_workers=None):
+    """
+    fit_mnf fits a minimum noise fraction transform on all pixels of one or more reflectance h5
+    files in a single pass, with the noise estimated by shift differences
+    """
+    return SpectralTransform.mnf(accumulate_files(refl_filenames,True,block_size,max_workers))
+
+def project_file(transform,refl_filename,out_filename,n_components=10,block_size=(256,256)):
+    """
+    project_file writes the first n_components components of a reflectance h5 file to a tiled,
+    compressed multi-band GeoTIFF, one window at a time
+    --------
+    Usage:
+    --------
+    project_file(pca,'NEON_D02_SERC_DP3_368000_4306000_reflectance.h5','SERC_368000_4306000_PCA.tif',3)
+    """
+    from neon_aop_indices import create_geotiff
+    with ReflectanceTile(refl_filename) as tile:
+        dataset = create_geotiff(out_filename,tile,n_components)
+        for band in range(n_components):
+            dataset.GetRasterBand(band+1).SetNoDataValue(np.nan)
+        for window in tile.iter_windows(block_size):
+            components = transform.transform(tile.read_clean(window),n_components)
+            for band in range(n_components):
+                dataset.GetRasterBand(band+1).WriteArray(components[:,:,band],window[1][0],window[0][0])
+        dataset.FlushCache()
+        dataset = None
+    return out_filename
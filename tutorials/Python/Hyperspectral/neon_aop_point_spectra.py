@@ -0,0 +1,147 @@
+# -*- coding: utf-8 -*-
+"""
+Batch extraction of reflectance spectra at many coordinates from many reflectance h5 files.
+
+hyperspectral_variation_py opens every flightline in a directory, one after the other, to pull
+the spectrum of a single coordinate. extract_point_spectra takes N coordinates (an array, a CSV
+of plots, or a shapefile) and M reflectance files, reads only the metadata of each file to find
+which points it contains, and then reads only those pixels (optionally averaged over a small
+window), with the files processed in parallel.
+"""
+
+import glob, os
+import numpy as np
+from concurrent.futures import ProcessPoolExecutor
+from neon_aop_hyperspectral import ReflectanceTile, read_metadata
+
+def read_points(points,x_field='easting',y_field='northing',id_field=None,epsg=None):
+    """
+    read_points returns (ids, x, y) arrays from a list/array of (x, y) coordinates, a CSV file,
+    or a shapefile / GeoJSON (point geometries, or the centroids of polygons)
+    --------
+     Inputs:
+         points: array-like of shape (N,2), CSV filename, or shapefile / GeoJSON filename
+         x_field, y_field: CSV column names of the UTM coordinates; default 'easting', 'northing'
+         id_field: CSV or shapefile column with point ids; default None (ids are 0..N-1)
+         epsg: EPSG code to reproject shapefile geometries to (the UTM zone of the
+               reflectance files); default None (already in UTM)
+    """
+    if isinstance(points,str) and points.lower().endswith('.csv'):
+        import pandas
+        table = pandas.read_csv(points)
+        x, y = table[x_field].values.astype(float), table[y_field].values.astype(float)
+        ids = table[id_field].values if id_field is not None else np.arange(len(x))
+    elif isinstance(points,str):
+        import geopandas as gpd
+        gdf = gpd.read_file(points)
+        if epsg is not None:
+            gdf = gdf.to_crs(epsg=epsg)
+        centroids = gdf.geometry.centroid
+        x, y = centroids.x.values, centroids.y.values
+        ids = gdf[id_field].values if id_field is not None else np.arange(len(x))
+    else:
+        points = np.asarray(points,dtype=float).reshape(-1,2)
+        x, y = points[:,0], points[:,1]
+        ids = np.arange(len(x))
+    return np.asarray(ids), np.asarray(x), np.asarray(y)
+
+def build_point_index(refl_filenames,x,y):
+    """
+    build_point_index reads the metadata (not the reflectance data) of each file and returns
+    {filename: (point indices, rows, columns)} for the points that fall inside it, plus the
+    wavelengths of the first file
+    """
+    index = {}
+    wavelengths = None
+    for refl_filename in refl_filenames:
+        md = read_metadata(refl_filename)
+        if wavelengths is None:
+            wavelengths = md.wavelengths
+        inside = np.flatnonzero(md.contains(x,y))
+        if len(inside) == 0:
+            continue
+        rows, cols = md.world_to_pixel(x[inside],y[inside])
+        index[refl_filename] = (inside,rows,cols)
+    return index, wavelengths
+
+def _extract_file_spectra(args):
+    # worker: read the window around each point of one file, returns (point indices, spectra, n valid pixels)
+    refl_filename, point_indices, rows, cols, window_size = args
+    half = window_size//2
+    with ReflectanceTile(refl_filename) as tile:
+        spectra = np.full((len(point_indices),tile.shape[2]),np.nan,dtype=np.float32)
+        n_pixels = np.zeros(len(point_indices),dtype=int)
+        for i, (row, col) in enumerate(zip(rows,cols)):
+            window = ((max(row-half,0),min(row+half+1,tile.shape[0])),
+                      (max(col-half,0),min(col+half+1,tile.shape[1])))
+            refl = tile.read(window).reshape(-1,tile.shape[2])
+            valid = ~np.all(np.isnan(refl),axis=1)
+            n_pixels[i] = valid.sum()
+            if n_pixels[i]:
+                spectra[i] = np.nanmean(refl[valid],axis=0)
+    return point_indices, spectra, n_pixels
+
+def extract_point_spectra(points,refl_filenames,window_size=1,max_workers=None,**point_args):
+    """
+    extract_point_spectra extracts the reflectance spectrum at each point from every
+    reflectance file that contains it
+    --------
+     Inputs:
+         points: (N,2) array-like of UTM coordinates, CSV filename, or shapefile (see read_points)
+         refl_filenames: list of reflectance h5 filenames, a folder, or a glob pattern
+         window_size: odd width (pixels) of the square window averaged around each point;
+                      default 1 (the pixel containing the point)
+         max_workers: number of processes; default None (number of CPUs)
+         point_args: x_field, y_field, id_field, epsg passed to read_points
+    --------
+     Returns:
+         numpy structured array with one record per (point, file) pair, with fields
+         id, x, y, file, row, col, n_pixels (valid pixels averaged) and spectrum (bands,);
+         and the wavelengths (nm)
+    --------
+    Usage:
+    --------
+    spectra, wavelengths = extract_point_spectra('./plots.csv','./data/BRDF/',window_size=3,id_field='plotID')
+    import pandas; df = pandas.DataFrame(spectra[['id','file','n_pixels']])
+    """
+    if isinstance(refl_filenames,str):
+        pattern = os.path.join(refl_filenames,'*.h5') if os.path.isdir(refl_filenames) else refl_filenames
+        refl_filenames = sorted(glob.glob(pattern))
+    ids, x, y = read_points(points,**point_args)
+    index, wavelengths = build_point_index(refl_filenames,x,y)
+
+    args = [(f,inside,rows,cols,window_size) for f, (inside,rows,cols) in index.items()]
+    with ProcessPoolExecutor(max_workers=max_workers) as executor:
+        results = list(executor.map(_extract_file_spectra,args))
+
+    n_records = sum(len(inside) for inside, rows, cols in index.values())
+    n_bands = len(wavelengths) if wavelengths is not None else 0
+    name_length = max([len(f) for f in index] + [1])
+    dtype = [('id',ids.dtype if ids.dtype.kind in 'iuf' else 'U64'),('x','f8'),('y','f8'),('file','U' + str(name_length)),
+             ('row','i4'),('col','i4'),('n_pixels','i4'),('spectrum','f4',(n_bands,))]
+    table = np.zeros(n_records,dtype=dtype)
+    offset = 0
+    for (f, (inside,rows,cols)), (point_indices,spectra,n_pixels) in zip(index.items(),results):
+        records = table[offset:offset+len(inside)]
+        records['id'] = ids[inside]
+        records['x'], records['y'] = x[inside], y[inside]
+        records['file'] = f
+        records['row'], records['col'] = rows, cols
+        records['n_pixels'] = n_pixels
+        records['spectrum'] = spectra
+        offset += len(inside)
+    return table, wavelengths
+
+def point_spectra_dataframe(table,wavelengths):
+    """
+    point_spectra_dataframe converts the output of extract_point_spectra to a tidy pandas
+    DataFrame with one row per (point, file, band): id, x, y, file, wavelength, reflectance
+    """
+    import pandas
+    n_bands = len(wavelengths)
+    return pandas.DataFrame({'id':np.repeat(table['id'],n_bands),
+                             'x':np.repeat(table['x'],n_bands),
+                             'y':np.repeat(table['y'],n_bands),
+                             'file':np.repeat(table['file'],n_bands),
+                             'wavelength':np.tile(wavelengths,len(table)),
+                             'reflectance':table['spectrum'].ravel()})
@@ -0,0 +1,211 @@
+# -*- coding: utf-8 -*-
+"""
+Functions to summarize reflectance spectra of pixels grouped by NDVI (or any other index)
+thresholds, eg. the mean spectra of NDVI > 0.6 and NDVI < 0.3 in the NDVI tutorial.
+
+calculate_mean_masked_spectra in Calc_NDVI_Extract_Spectra_Masks_Tiles_py rebuilds the same
+NDVI mask for each of the 426 bands. Here the class masks are computed once and each class
+is reduced over a (pixels x bands) array in a single vectorized pass. MaskedSpectraAccumulator
+does the same over windows of ReflectanceTile files, so whole flightlines can be summarized
+without loading them.
+"""
+
+import numpy as np
+from neon_aop_hyperspectral import ReflectanceTile
+
+def class_masks(index,classes):
+    """
+    class_masks returns a dictionary of boolean masks {class name: mask} for an index array
+    (eg. NDVI). NaN index values are never in a class.
+    --------
+     Inputs:
+         index: array of index values (eg. NDVI), any shape
+         classes: dictionary {class name: rule}, where a rule is ('>',threshold), ('<',threshold),
+                  ('>=',threshold), ('<=',threshold), or (low,high) for low <= index < high
+    --------
+    Usage:
+    --------
+    masks = class_masks(ndvi,{'ndvi_gtpt6':('>',0.6),'ndvi_ltpt3':('<',0.3),'mid':(0.3,0.6)})
+    """
+    masks = {}
+    with np.errstate(invalid='ignore'):
+        for name, rule in classes.items():
+            if rule[0] == '>':
+                masks[name] = index > rule[1]
+            elif rule[0] == '<':
+                masks[name] = index < rule[1]
+            elif rule[0] == '>=':
+                masks[name] = index >= rule[1]
+            elif rule[0] == '<=':
+                masks[name] = index <= rule[1]
+            else:
+                masks[name] = (index >= rule[0]) & (index < rule[1])
+    return masks
+
+def calculate_masked_spectra(reflArray,index,classes,stats=('mean',),percentiles=()):
+    """
+    calculate_masked_spectra computes spectra statistics of the pixels in each class in one
+    vectorized pass per class over a (pixels x bands) view of the reflectance array
+    --------
+     Inputs:
+         reflArray: reflectance array (rows, columns, bands)
+         index: index array (rows, columns), eg. NDVI
+         classes: dictionary {class name: rule}, see class_masks
+         stats: any of 'mean', 'std', 'median', 'count'; default ('mean',)
+         percentiles: list of percentiles (0-100), returned as 'p<percentile>' (eg. 'p90'); default ()
+    --------
+     Returns:
+         dictionary {class name: {statistic: spectrum array of length bands}}; NaN (no data)
+         reflectance values are ignored
+    --------
+    Usage:
+    --------
+    spectra = calculate_masked_spectra(sercRefl,ndvi,{'ndvi_gtpt6':('>',0.6),'ndvi_ltpt3':('<',0.3)},
+                                       stats=('mean','std','median'),percentiles=(10,90))
+    sercSpectra_ndvi_gtpt6 = spectra['ndvi_gtpt6']['mean']
+    """
+    pixels = reflArray.reshape(-1,reflArray.shape[2])
+    results = {}
+    for name, mask in class_masks(index,classes).items():
+        selected = pixels[mask.ravel()]
+        results[name] = {}
+        with np.errstate(invalid='ignore',divide='ignore'):
+            if 'count' in stats:
+                results[name]['count'] = np.sum(~np.isnan(selected),axis=0)
+            if 'mean' in stats:
+                results[name]['mean'] = np.nanmean(selected,axis=0) if len(selected) else np.full(pixels.shape[1],np.nan)
+            if 'std' in stats:
+                results[name]['std'] = np.nanstd(selected,axis=0) if len(selected) else np.full(pixels.shape[1],np.nan)
+            if 'median' in stats or len(percentiles):
+                q = ([50] if 'median' in stats else []) + list(percentiles)
+                if len(selected):
+                    values = np.nanpercentile(selected,q,axis=0)
+                else:
+                    values = np.full((len(q),pixels.shape[1]),np.nan)
+                if 'median' in stats:
+                    results[name]['median'] = values[0]
+                    values = values[1:]
+                for p, v in zip(percentiles,values):
+                    results[name]['p' + str(p)] = v
+    return results
+
+def calculate_mean_masked_spectra(reflArray,ndvi,ndvi_threshold,ineq='>'):
+    """
+    calculate_mean_masked_spectra returns the mean spectrum of pixels with ndvi > ndvi_threshold
+    (ineq='>') or ndvi < ndvi_threshold (ineq='<'); same inputs and output as the function in
+    the NDVI tutorial, computed with calculate_masked_spectra
+    """
+    if ineq not in ('>','<'):
+        print('ERROR: Invalid inequality. Enter < or >')
+        return
+    return calculate_masked_spectra(reflArray,ndvi,{'masked':(ineq,ndvi_threshold)})['masked']['mean']
+
+class MaskedSpectraAccumulator(object):
+    """
+    MaskedSpectraAccumulator accumulates per-class spectra statistics over blocks of pixels,
+    so statistics for tiles or flightlines larger than memory can be computed window by window.
+    Mean and std are exact (running sums); median and percentiles are estimated from per-band
+    histograms with bins of width (hist_range[1]-hist_range[0])/bins.
+    --------
+     Inputs:
+         n_bands: number of bands
+         classes: dictionary {class name: rule}, see class_masks
+         percentiles: list of percentiles (0-100) to estimate, in addition to the median; default ()
+         hist_range: (min, max) reflectance of the histograms; default (0,1.5)
+         bins: number of histogram bins; default 1500 (0.001 reflectance)
+    --------
+    Usage:
+    --------
+    acc = MaskedSpectraAccumulator(426,{'veg':('>',0.6),'soil':('<',0.3)})
+    for refl_block, ndvi_block in blocks:
+        acc.update(refl_block,ndvi_block)
+    spectra = acc.result()
+    """
+    def __init__(self,n_bands,classes,percentiles=(),hist_range=(0,1.5),bins=1500):
+        self.n_bands = n_bands
+        self.classes = classes
+        self.percentiles = list(percentiles)
+        self.hist_range = hist_range
+        self.bins = bins
+        self.count = {name:np.zeros(n_bands,dtype=np.int64) for name in classes}
+        self.sum = {name:np.zeros(n_bands) for name in classes}
+        self.sum_sq = {name:np.zeros(n_bands) for name in classes}
+        self.hist = {name:np.zeros((n_bands,bins),dtype=np.int64) for name in classes}
+
+    def update(self,refl_block,index_block):
+        # add a (rows, columns, bands) reflectance block and its (rows, columns) index block
+        pixels = refl_block.reshape(-1,self.n_bands)
+        width = (self.hist_range[1] - self.hist_range[0])/self.bins
+        band_offsets = np.arange(self.n_bands)*self.bins
+        for name, mask in class_masks(index_block,self.classes).items():
+            selected = pixels[mask.ravel()].astype(np.float64)
+            if len(selected) == 0:
+                continue
+            valid = ~np.isnan(selected)
+            self.count[name] += valid.sum(axis=0)
+            selected[~valid] = 0
+            self.sum[name] += selected.sum(axis=0)
+            self.sum_sq[name] += np.einsum('ij,ij->j',selected,selected)
+            bin_index = np.clip(((selected - self.hist_range[0])/width).astype(np.int64),0,self.bins-1)
+            flat = (bin_index + band_offsets)[valid]
+            self.hist[name] += np.bincount(flat,minlength=self.n_bands*self.bins).reshape(self.n_bands,self.bins)
+
+    def _hist_percentile(self,name,q):
+        cumulative = np.cumsum(self.hist[name],axis=1)
+        target = cumulative[:,-1:]*q/100.
+        bin_index = np.argmax(cumulative >= target,axis=1)
+        width = (self.hist_range[1] - self.hist_range[0])/self.bins
+        values = self.hist_range[0] + (bin_index + 0.5)*width
+        values[cumulative[:,-1] == 0] = np.nan
+        return values
+
+    def result(self):
+        """
+        result returns {class name: {'count','mean','std','median','p<percentile>': spectrum}}
+        """
+        results = {}
+        for name in self.classes:
+            with np.errstate(invalid='ignore',divide='ignore'):
+                mean = self.sum[name]/self.count[name]
+                var = self.sum_sq[name]/self.count[name] - mean**2
+            results[name] = {'count':self.count[name],'mean':mean,'std':np.sqrt(np.maximum(var,0))}
+            results[name]['median'] = self._hist_percentile(name,50)
+            for p in self.percentiles:
+                results[name]['p' + str(p)] = self._hist_percentile(name,p)
+        return results
+
+def calculate_masked_spectra_files(refl_filenames,classes,vis_band=57,nir_band=89,percentiles=(),
+                                   block_size=(256,256)):
+    """
+    calculate_masked_spectra_files summarizes NDVI class spectra over one or more reflectance
+    h5 files (tiles or flightlines), reading one window at a time with ReflectanceTile. NDVI is
+    computed from vis_band and nir_band (defaults are bands 58 and 90, as in the NDVI tutorial).
+    --------
+     Inputs:
+         refl_filenames: reflectance h5 filename or list of filenames
+         classes: dictionary {class name: rule}, see class_masks
+         vis_band, nir_band: 0-based band indices used for NDVI; default 57, 89
+         percentiles: list of percentiles (0-100) estimated in addition to the median; default ()
+         block_size: (rows, columns) of the windows read at a time; default (256,256)
+    --------
+     Returns:
+         dictionary {class name: {statistic: spectrum}}, see MaskedSpectraAccumulator.result
+    --------
+    Usage:
+    --------
+    spectra = calculate_masked_spectra_files(flightline_files,{'veg':('>',0.6),'soil':('<',0.3)})
+    """
+    if isinstance(refl_filenames,str):
+        refl_filenames = [refl_filenames]
+    accumulator = None
+    for refl_filename in refl_filenames:
+        with ReflectanceTile(refl_filename) as tile:
+            if accumulator is None:
+                accumulator = MaskedSpectraAccumulator(tile.shape[2],classes,percentiles)
+            for window in tile.iter_windows(block_size):
+                refl = tile.read(window)
+                vis, nir = refl[:,:,vis_band], refl[:,:,nir_band]
+                with np.errstate(invalid='ignore',divide='ignore'):
+                    ndvi = (nir - vis)/(nir + vis)
+                accumulator.update(refl,ndvi)
+    return accumulator.result()
@@ -0,0 +1,185 @@
+# -*- coding: utf-8 -*-
+"""
+Linear spectral unmixing of NEON AOP reflectance over spatial blocks with a process pool.
+
+The endmember extraction tutorial runs pysptools eea.NFINDR().extract and amap.FCLS().map
+single-threaded on the whole 1000 x 1000 x 360 cube. Here the fully constrained least squares
+(FCLS: abundances >= 0, summing to 1) problem is solved for a block of pixels at once with a
+batched Lawson-Hanson active-set NNLS on the normal equations, where pixels that share the same
+passive set are solved together. Blocks of rows are distributed over a process pool reading the
+cube from shared memory (or from the h5 file), and abundance maps are written to a .npy memmap
+as each block finishes.
+"""
+
+import numpy as np
+from concurrent.futures import ProcessPoolExecutor, as_completed
+from multiprocessing import shared_memory
+from neon_aop_hyperspectral import ReflectanceTile
+
+def _solve_passive(AtA,Atb,passive):
+    # least squares solution restricted to each pixel's passive set; pixels with the same
+    # passive set are solved together with one p x p system
+    n, p = Atb.shape
+    z = np.zeros((n,p))
+    codes = passive.dot(1 << np.arange(p))
+    for code in np.unique(codes):
+        rows = np.flatnonzero(codes == code)
+        cols = np.flatnonzero(passive[rows[0]])
+        if len(cols) == 0:
+            continue
+        z[np.ix_(rows,cols)] = np.linalg.solve(AtA[np.ix_(cols,cols)],Atb[np.ix_(rows,cols)].T).T
+    return z
+
+def nnls_batch(AtA,Atb,tol=1e-10,max_iter=None):
+    """
+    nnls_batch solves min ||A x - b||, x >= 0 for many right hand sides b at once with the
+    Lawson-Hanson active-set method, given the normal equations AtA = A.T A (p x p) and
+    Atb = B A (n x p, one row per pixel)
+    --------
+     Returns:
+         x: (n, p) non-negative solutions
+    """
+    n, p = Atb.shape
+    max_iter = 3*p if max_iter is None else max_iter
+    x = np.zeros((n,p))
+    passive = np.zeros((n,p),dtype=bool)
+    running = np.ones(n,dtype=bool)
+    for it in range(max_iter):
+        w = Atb - x.dot(AtA)
+        w[passive] = -np.inf
+        j = np.argmax(w,axis=1)
+        running &= w[np.arange(n),j] > tol
+        if not running.any():
+            break
+        inner = np.flatnonzero(running)
+        passive[inner,j[inner]] = True
+        for inner_it in range(max_iter):
+            z = _solve_passive(AtA,Atb[inner],passive[inner])
+            negative = passive[inner] & (z <= tol)
+            infeasible = negative.any(axis=1)
+            x[inner[~infeasible]] = z[~infeasible]
+            if not infeasible.any():
+                break
+            #step from x towards z until the first passive variable reaches zero, then drop it
+            inner = inner[infeasible]
+            z, negative = z[infeasible], negative[infeasible]
+            x_inner = x[inner]
+            with np.errstate(divide='ignore',invalid='ignore'):
+                ratio = np.where(negative,x_inner/(x_inner - z),np.inf)
+            alpha = ratio.min(axis=1)[:,None]
+            x_inner = x_inner + alpha*(z - x_inner)
+            passive[inner] &= x_inner > tol
+            x_inner[~passive[inner]] = 0
+            x[inner] = x_inner
+    return x
+
+def fcls_normal_equations(E,delta=1e3):
+    """
+    fcls_normal_equations returns (AtA, delta) for FCLS with endmembers E (p x bands): the
+    sum-to-one constraint is added as an extra row of delta to the endmember matrix
+    (Heinz & Chang, 2001), so FCLS becomes NNLS on the augmented system
+    """
+    E = np.asarray(E,dtype=np.float64)
+    return E.dot(E.T) + delta**2, delta
+
+def fcls_batch(pixels,E,delta=1e3):
+    """
+    fcls_batch computes fully constrained abundances (>= 0, summing to 1) for a
+    (pixels x bands) array and endmembers E (p x bands); pixels with NaN are returned as NaN
+    """
+    AtA, delta = fcls_normal_equations(E,delta)
+    pixels = np.asarray(pixels,dtype=np.float64)
+    valid = ~np.isnan(pixels).any(axis=1)
+    abundances = np.full((pixels.shape[0],AtA.shape[0]),np.nan,dtype=np.float32)
+    if valid.any():
+        Atb = pixels[valid].dot(np.asarray(E,dtype=np.float64).T) + delta**2
+        abundances[valid] = nnls_batch(AtA,Atb)
+    return abundances
+
+def extract_endmembers(data,q,n_samples=100000,seed=0,**nfindr_args):
+    """
+    extract_endmembers runs pysptools NFINDR on a random sample of n_samples valid pixels
+    instead of the whole cube, and returns the endmembers U (q x bands)
+    --------
+    Usage:
+    --------
+    U = extract_endmembers(data_clean,4)
+    """
+    import pysptools.eea as eea
+    pixels = data.reshape(-1,data.shape[-1])
+    valid = np.flatnonzero(~np.isnan(pixels).any(axis=1))
+    rng = np.random.default_rng(seed)
+    sample = pixels[rng.choice(valid,min(n_samples,len(valid)),replace=False)]
+    return eea.NFINDR().extract(sample[:,np.newaxis,:].astype(np.float32),q,**nfindr_args)
+
+def _unmix_shared_block(args):
+    # worker: unmix rows [r0, r1) of the cube in shared memory
+    shm_name, shape, dtype, E, delta, r0, r1 = args
+    shm = shared_memory.SharedMemory(name=shm_name)
+    try:
+        data = np.ndarray(shape,dtype=dtype,buffer=shm.buf)
+        pixels = np.array(data[r0:r1].reshape(-1,shape[2]))
+    finally:
+        shm.close()
+    return r0, r1, fcls_batch(pixels,E,delta).reshape(r1-r0,shape[1],-1)
+
+def _unmix_file_block(args):
+    # worker: read and unmix rows [r0, r1) of a reflectance h5 file (bad bands removed)
+    refl_filename, E, delta, r0, r1 = args
+    with ReflectanceTile(refl_filename) as tile:
+        refl = tile.read_clean(((r0,r1),(0,tile.shape[1])))
+    return r0, r1, fcls_batch(refl.reshape(-1,refl.shape[2]),E,delta).reshape(r1-r0,refl.shape[1],-1)
+
+def unmix_fcls(data,E,out_filename=None,block_rows=50,delta=1e3,max_workers=None):
+    """
+    unmix_fcls computes FCLS abundance maps over blocks of rows with a process pool
+    --------
+     Inputs:
+         data: cleaned reflectance array (rows, columns, bands), eg. data_clean from the tutorial,
+               which is shared with the workers through shared memory; or a reflectance h5
+               filename, in which case each worker reads its block with ReflectanceTile.read_clean
+         E: endmembers (p x bands), eg. U from NFINDR
+         out_filename: .npy file the abundances are written to block by block (opened with
+                       np.load(out_filename,mmap_mode='r')); default None (kept in memory)
+         block_rows: number of rows per block; default 50
+         delta: weight of the sum-to-one constraint; default 1e3
+         max_workers: number of processes; default None (number of CPUs)
+    --------
+     Returns:
+         abundance maps (rows, columns, p), float32 (a memmap if out_filename is given)
+    --------
+    Usage:
+    --------
+    amaps = unmix_fcls(data_clean,U,'SERC_abundances.npy')
+    """
+    E = np.asarray(E,dtype=np.float64)
+    p = E.shape[0]
+    shm = None
+    if isinstance(data,str):
+        with ReflectanceTile(data) as tile:
+            rows, cols = tile.shape[0], tile.shape[1]
+        jobs = [(data,E,delta,r0,min(r0+block_rows,rows)) for r0 in range(0,rows,block_rows)]
+        worker = _unmix_file_block
+    else:
+        rows, cols = data.shape[0], data.shape[1]
+        shm = shared_memory.SharedMemory(create=True,size=data.nbytes)
+        np.ndarray(data.shape,dtype=data.dtype,buffer=shm.buf)[:] = data
+        jobs = [(shm.name,data.shape,data.dtype,E,delta,r0,min(r0+block_rows,rows)) for r0 in range(0,rows,block_rows)]
+        worker = _unmix_shared_block
+
+    if out_filename is not None:
+        abundances = np.lib.format.open_memmap(out_filename,mode='w+',dtype=np.float32,shape=(rows,cols,p))
+    else:
+        abundances = np.empty((rows,cols,p),dtype=np.float32)
+    try:
+        with ProcessPoolExecutor(max_workers=max_workers) as executor:
+            for future in as_completed([executor.submit(worker,job) for job in jobs]):
+                r0, r1, block = future.result()
+                abundances[r0:r1] = block
+                if out_filename is not None:
+                    abundances.flush()
+    finally:
+        if shm is not None:
+            shm.close()
+            shm.unlink()
+    return abundances
@@ -178,7 +178,7 @@ def h5refl2array(h5_filename):
     #Calculate the xMax and yMin values from the dimensions\n",
     xMax = xMin + (refl_shape[1]*float(metadata['res']['pixelWidth'])) #xMax = left edge + (# of columns * resolution)\n",
     yMin = yMax - (refl_shape[0]*float(metadata['res']['pixelHeight'])) #yMin = top edge - (# of rows * resolution)\n",
-    metadata['extent'] = (xMin,xMax,yMin,yMax),
+    metadata['extent'] = (xMin,xMax,yMin,yMax)
     metadata['ext_dict'] = {}
     metadata['ext_dict']['xMin'] = xMin
     metadata['ext_dict']['xMax'] = xMax
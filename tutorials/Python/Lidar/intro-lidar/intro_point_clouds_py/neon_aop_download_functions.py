@@ -6,7 +6,137 @@ Created on Mon Apr  8 08:18:00 2019
 Functions to display available urls and download NEON AOP data using the NEON Data API.
 """
 
-import requests, urllib, os
+import requests, os, re, shutil, threading, time, json, hashlib, zlib, math
+from collections import namedtuple
+from concurrent.futures import ThreadPoolExecutor, as_completed
+
+SERVER = 'http://data.neonscience.org/api/v0/'
+
+#product, site, and month manifests are cached on disk for CACHE_TTL seconds, after which 
+#they are revalidated with the server using their ETag
+CACHE_DIR = os.path.join(os.path.expanduser('~'),'.neon_api_cache')
+CACHE_TTL = 24*60*60
+
+#one planned download: file name, url, size (bytes), md5 / crc32 checksums (None if the 
+#manifest does not provide them), and local target path
+PlannedFile = namedtuple('PlannedFile',['name','url','size','md5','crc32','path'])
+
+#AOP mosaic file names contain the easting and northing of the lower left corner of the 
+#1 km tile, eg. NEON_D14_JORN_DP3_314000_3610000_CHM.tif
+TILE_SIZE = 1000
+_tile_pattern = re.compile(r'_(\d{6})_(\d{7})_')
+
+#content-addressed store of downloaded files, keyed by the checksums in the API file manifest
+STORE_DIR = os.path.join(os.path.expanduser('~'),'.neon_aop_store')
+
+#default number of bytes read from the response and written to disk at a time
+CHUNK_SIZE = 4*1024*1024
+
+#each worker thread keeps its own requests.Session so connections to a host are reused
+_thread_local = threading.local()
+
+#parsed api responses (url -> {'url', 'etag', 'time' checked, 'data' json}, as in the cache files) and 
+#site code indices (product -> {site: siteCodes entry})
+_memory_cache = {}
+_site_index = {}
+_cache_lock = threading.Lock()
+
+def get_api_json(url,ttl=CACHE_TTL,cache_dir=CACHE_DIR):
+    """
+    get_api_json returns the parsed json response for a NEON API url, using an in-memory 
+    and on-disk cache. Responses younger than ttl are returned without contacting the 
+    server; older responses are revalidated with an If-None-Match (ETag) request and 
+    only downloaded and parsed again if they have changed.
+    --------
+     Inputs:
+         url: NEON API url (eg. SERVER + 'products/DP3.30015.001')
+         ttl: number of seconds a cached response is used without revalidation; default CACHE_TTL (1 day)
+         cache_dir: folder to store cached responses; default CACHE_DIR (~/.neon_api_cache), 
+                    None to only cache in memory
+    --------
+    Usage:
+    --------
+    chm_product = get_api_json(SERVER + 'products/DP3.30015.001')
+    """
+    now = time.time()
+    with _cache_lock:
+        entry = _memory_cache.get(url)
+    if entry is not None and now - entry['time'] < ttl:
+        return entry['data']
+    
+    cache_file = None
+    if cache_dir is not None:
+        cache_file = os.path.join(cache_dir,hashlib.sha1(url.encode('utf-8')).hexdigest() + '.json')
+        if os.path.exists(cache_file):
+            with open(cache_file) as f:
+                disk_entry = json.load(f)
+            if entry is None or disk_entry['time'] > entry['time']:
+                entry = disk_entry
+            if now - entry['time'] < ttl:
+                with _cache_lock:
+                    _memory_cache[url] = entry
+                return entry['data']
+    
+    #an expired entry, from memory or disk, is revalidated with its ETag
+    headers = {}
+    if entry is not None and entry.get('etag'):
+        headers['If-None-Match'] = entry['etag']
+    r = _get_session().get(url,headers=headers,timeout=60)
+    if r.status_code == 304:
+        entry = dict(entry,time=now)
+    else:
+        r.raise_for_status()
+        entry = {'url':url,'etag':r.headers.get('ETag'),'time':now,'data':r.json()}
+    
+    if cache_file is not None:
+        if not os.path.exists(cache_dir):
+            os.makedirs(cache_dir,exist_ok=True)
+        tmp_file = cache_file + '.' + str(os.getpid()) + '.' + str(threading.get_ident()) + '.tmp'
+        with open(tmp_file,'w') as f:
+            json.dump(entry,f)
+        os.replace(tmp_file,cache_file)
+    with _cache_lock:
+        _memory_cache[url] = entry
+    return entry['data']
+
+def get_site_index(product,ttl=CACHE_TTL):
+    """
+    get_site_index returns a dictionary of the siteCodes entries of a product, keyed by site 
+    code (eg. index['JORN']['availableDataUrls']). The index is built once per product 
+    response, so repeated lookups do not re-scan the product json.
+    """
+    data = get_api_json(SERVER + 'products/' + product,ttl)
+    with _cache_lock:
+        cached = _site_index.get(product)
+        if cached is None or cached[0] is not data:
+            cached = (data,{s['siteCode']:s for s in data['data']['siteCodes']})
+            _site_index[product] = cached
+    return cached[1]
+
+def get_site_json(site,ttl=CACHE_TTL):
+    """
+    get_site_json returns the cached site manifest (SERVER + 'sites/' + site) for a NEON site
+    """
+    return get_api_json(SERVER + 'sites/' + site,ttl)
+
+def get_month_files(url,ttl=CACHE_TTL):
+    """
+    get_month_files returns the list of files ('name', 'url', 'size', ...) in a cached 
+    month manifest, eg. one of the urls returned by list_available_urls
+    """
+    return get_api_json(url,ttl)['data']['files']
+
+def clear_cache(cache_dir=CACHE_DIR):
+    """
+    clear_cache empties the in-memory cache and removes the cached responses in cache_dir
+    """
+    with _cache_lock:
+        _memory_cache.clear()
+        _site_index.clear()
+    if cache_dir is not None and os.path.exists(cache_dir):
+        for f in os.listdir(cache_dir):
+            if f.endswith('.json'):
+                os.remove(os.path.join(cache_dir,f))
 
 def list_available_urls(product,site):
     """
@@ -20,10 +150,8 @@ def list_available_urls(product,site):
     --------
     jorn_chm_urls = list_available_urls('DP3.30015.001','JORN')
     """
-    r = requests.get("http://data.neonscience.org/api/v0/products/" + product)
-    for i in range(len(r.json()['data']['siteCodes'])):
-        if site in r.json()['data']['siteCodes'][i]['siteCode']:
-            data_urls=r.json()['data']['siteCodes'][i]['availableDataUrls']
+    site_index = get_site_index(product)
+    data_urls = site_index[site]['availableDataUrls'] if site in site_index else []
     if len(data_urls)==0:
         print('WARNING: no urls found for product ' + product + ' at site ' + site)
     else:
@@ -42,68 +170,357 @@ def list_available_urls_by_year(product,site,year):
     --------
     jorn_chm_2018_url = list_available_urls_by_year('DP3.30015.001','JORN','2018')
     """
-    r = requests.get("http://data.neonscience.org/api/v0/products/" + product)
-    for i in range(len(r.json()['data']['siteCodes'])):
-        if site in r.json()['data']['siteCodes'][i]['siteCode']:
-            all_data_urls=r.json()['data']['siteCodes'][i]['availableDataUrls']
+    site_index = get_site_index(product)
+    all_data_urls = site_index[site]['availableDataUrls'] if site in site_index else []
     data_urls = [url for url in all_data_urls if year in url]
     if len(data_urls)==0:
         print('WARNING: no urls found for product ' + product + ' at site ' + site + ' in year ' + year)
     else:
         return data_urls
     
-def download_urls(url_list,download_folder_root,zip=False):
-    # downloads data from urls to folder, maintaining month-year folder structure
-    for url in url_list:
-        month = url.split('/')[-1]
-        download_folder = download_folder_root + month + '/'
-        if not os.path.exists(download_folder):
-            os.makedirs(download_folder)
-        r=requests.get(url)
-        files=r.json()['data']['files']
-        for i in range(len(files)):
-            if zip==False:
-                if '.zip' not in files[i]['name']:
-                    print('downloading ' + files[i]['name'] + ' to ' + download_folder)
-                    urllib.request.urlretrieve(files[i]['url'],download_folder + files[i]['name'])
-            elif zip==True:
-                if '.zip' in files[i]['name']:
-                    print('downloading ' + files[i]['name'] + ' to ' + download_folder)
-                    urllib.request.urlretrieve(files[i]['url'],download_folder + files[i]['name'])
-
-def download_file(url,filename):
-    r = requests.get(url)
-    with open(filename, 'wb') as f:
-        for chunk in r.iter_content(chunk_size=1024): 
-            if chunk: # filter out keep-alive new chunks
-                f.write(chunk)
-    return
+def plan_download(urls,download_folder,match_string=None,month_folders=False,max_workers=8):
+    """
+    plan_download fetches the month manifests for a list of api urls concurrently and 
+    returns a download plan, a list of PlannedFile(name, url, size, md5, crc32, path)
+    --------
+     Inputs:
+         urls: list of api urls, eg. from list_available_urls or list_available_urls_by_year
+         download_folder: folder to store downloaded files
+         match_string: subset of data to match, need to use exact pattern for file name; default None (all files)
+         month_folders: store the files of each url in a download_folder/YYYY-MM sub-folder; default False
+                        (files with the same name in several months are planned once, from the latest month)
+         max_workers: number of manifests requested at the same time; default 8
+    --------
+    Usage:
+    --------
+    urls = list_available_urls_by_year('DP3.30015.001','JORN','2019')
+    plan = plan_download(urls,'./data/JORN_2019/CHM','314000_3610000_CHM.tif')
+    """
+    with ThreadPoolExecutor(max_workers=max_workers) as executor:
+        manifests = list(executor.map(get_month_files,urls))
+    
+    #one entry per local path: without month folders, files with the same name in several
+    #months (eg. DP3 tiles, whose names have no year) keep only the latest month
+    plan = {}
+    for url, files in sorted(zip(urls,manifests),key=lambda item: item[0].split('/')[-1]):
+        folder = os.path.join(download_folder,url.split('/')[-1]) if month_folders else download_folder
+        for f in files:
+            if match_string is None or match_string in f['name']:
+                path = os.path.join(folder,f['name'])
+                plan[path] = PlannedFile(f['name'],f['url'],int(f['size']),f.get('md5'),f.get('crc32'),path)
+    return list(plan.values())
 
-def get_file_size(urls,match_string):
-    size=0
-    for url in urls:
-        r = requests.get(url)
-        files = r.json()['data']['files']
-        for i in range(len(files)):
-            if match_string is not None:
-                if match_string in files[i]['name']:
-    #             print('downloading ' + files[i]['name'] + ' to ' + download_folder)
-                    size += int(files[i]['size'])
-            else:
-                size += int(files[i]['size'])
+def download_urls(url_list,download_folder_root,zip=False,max_workers=4,store_dir=None):
+    # downloads data from urls to folder, maintaining month-year folder structure; 
+    # if store_dir is given files are linked from a content-addressed store (see download_files_to_store)
+    plan = plan_download(url_list,download_folder_root,month_folders=True)
+    plan = [f for f in plan if ('.zip' in f.name) == zip]
+    if store_dir is not None:
+        return download_files_to_store(plan,store_dir,max_workers=max_workers)
+    return download_files(plan,max_workers=max_workers)
+
+def _get_session():
+    if not hasattr(_thread_local,'session'):
+        _thread_local.session = requests.Session()
+    return _thread_local.session
+
+def format_size(size):
+    """
+    format_size returns a human readable string for a size in bytes (eg. '1.25 GB')
+    """
     if size < 10**3:
-        print('Download size:',size,'bytes')
-    elif size > 10**3 and size < 10**6:
-        print('Download size:',round(size/(10**6),2),'kB')
-    elif size > 10**6 and size < 10**9:
-        print('Download size:',round(size/(10**6),2),'MB')
-    elif size > 10**9 and size < 10**12:
-        print('Download size:',round(size/(10**9),2),'GB')
+        return str(size) + ' bytes'
+    elif size < 10**6:
+        return str(round(size/(10**3),2)) + ' kB'
+    elif size < 10**9:
+        return str(round(size/(10**6),2)) + ' MB'
+    elif size < 10**12:
+        return str(round(size/(10**9),2)) + ' GB'
+    else:
+        return str(round(size/(10**12),2)) + ' TB'
+
+class _Crc32(object):
+    # running crc32 with the same update/hexdigest interface as the hashlib objects
+    def __init__(self):
+        self.value = 0
+    def update(self,data):
+        self.value = zlib.crc32(data,self.value)
+    def hexdigest(self):
+        return format(self.value & 0xffffffff,'08x')
+
+def _new_checksum(md5=None,crc32=None):
+    if md5:
+        return hashlib.md5(), md5.lower()
+    if crc32:
+        return _Crc32(), crc32.lower().replace('0x','').zfill(8)
+    return None, None
+
+def _hash_file(filename,checksum,chunk_size=CHUNK_SIZE):
+    # update a checksum (or do nothing if it is None) with the contents of a file
+    if checksum is None:
+        return
+    with open(filename,'rb') as f:
+        for chunk in iter(lambda: f.read(chunk_size),b''):
+            checksum.update(chunk)
+
+def download_file(url,filename,size=None,md5=None,crc32=None,chunk_size=CHUNK_SIZE,timeout=60):
+    """
+    download_file streams a single file to disk using the calling thread's session, so 
+    memory use stays at one chunk regardless of the file size. Data is written to a 
+    filename + '.part' temporary file, hashed on the fly, and renamed to filename only 
+    once the checksum from the API file manifest matches. If filename already has the 
+    expected size it is skipped, and an existing partial file is resumed with an HTTP 
+    Range request (or only verified and renamed if it is already complete).
+    --------
+     Inputs:
+         url: url of the file to download
+         filename: full path of the local file
+         size: expected size of the file in bytes (from the API 'size' field); default None
+         md5: expected md5 hex digest (from the API 'md5' field); default None
+         crc32: expected crc32 hex digest (from the API 'crc32' field), used if md5 is None; default None
+         chunk_size: number of bytes read and written at a time; default CHUNK_SIZE (4 MiB)
+         timeout: seconds to wait for the server to respond; default 60
+    --------
+     Returns:
+         number of bytes transferred (0 if the file was skipped)
+    --------
+    Usage:
+    --------
+    download_file(f.url,f.path,f.size,f.md5,f.crc32)
+    """
+    if size is not None:
+        size = int(size)
+        if os.path.exists(filename) and os.path.getsize(filename) == size:
+            return 0
+    
+    part_file = filename + '.part'
+    existing = os.path.getsize(part_file) if os.path.exists(part_file) else 0
+    if size is not None and existing > size: # partial file is larger than the remote file, start over
+        existing = 0
+    headers = {'Range':'bytes=' + str(existing) + '-'} if existing > 0 else {}
+    
+    checksum, expected = _new_checksum(md5,crc32)
+    transferred = 0
+    if size is not None and existing == size:
+        #the partial file is already complete (eg. interrupted before the rename): only verify it
+        _hash_file(part_file,checksum,chunk_size)
     else:
-        print('Download size:',round(size/(10**12),2),'TB')
+        with _get_session().get(url,headers=headers,stream=True,timeout=timeout) as r:
+            if r.status_code == 416 and existing > 0: # nothing left to download, verify what is on disk
+                _hash_file(part_file,checksum,chunk_size)
+            else:
+                r.raise_for_status()
+                if r.status_code != 206: # server ignored the Range header, rewrite the whole file
+                    existing = 0
+                with open(part_file,'r+b' if existing > 0 else 'wb') as f:
+                    #hash the bytes already on disk before appending the rest of the file
+                    if existing > 0 and checksum is not None:
+                        remaining = existing
+                        while remaining > 0:
+                            chunk = f.read(min(chunk_size,remaining))
+                            if not chunk:
+                                break
+                            checksum.update(chunk)
+                            remaining -= len(chunk)
+                    f.seek(existing)
+                    f.truncate()
+                    for chunk in r.iter_content(chunk_size=chunk_size):
+                        if chunk: # filter out keep-alive new chunks
+                            f.write(chunk)
+                            if checksum is not None:
+                                checksum.update(chunk)
+                            transferred += len(chunk)
+    
+    if checksum is not None and checksum.hexdigest() != expected:
+        os.remove(part_file)
+        raise IOError('checksum mismatch for ' + filename + ': expected ' + expected + 
+                      ', got ' + checksum.hexdigest())
+    os.replace(part_file,filename)
+    return transferred
+
+def download_files(plan,max_workers=4,chunk_size=CHUNK_SIZE):
+    """
+    download_files downloads the files in a download plan concurrently with a bounded pool 
+    of worker threads, resuming partial files, skipping files that are already complete, 
+    and verifying the md5/crc32 checksum of each file (see download_file)
+    --------
+     Inputs:
+         plan: list of PlannedFile, eg. from plan_download
+         max_workers: number of files downloaded at the same time; default 4
+         chunk_size: number of bytes read and written at a time; default CHUNK_SIZE (4 MiB)
+    --------
+     Returns:
+         dictionary with the number of 'downloaded', 'skipped' and 'failed' files, 
+         'bytes' transferred, elapsed 'seconds' and 'throughput' (bytes/s)
+    --------
+    Usage:
+    --------
+    plan = plan_download(urls,'./data/JORN_2019/CHM')
+    summary = download_files(plan,max_workers=8)
+    """
+    for folder in set(os.path.dirname(f.path) for f in plan):
+        if folder and not os.path.exists(folder):
+            os.makedirs(folder,exist_ok=True)
+    
+    summary = {'downloaded':0,'skipped':0,'failed':0,'bytes':0}
+    start = time.time()
+    with ThreadPoolExecutor(max_workers=max_workers) as executor:
+        futures = {}
+        for f in plan:
+            print('downloading ' + f.name + ' to ' + os.path.dirname(f.path))
+            future = executor.submit(download_file,f.url,f.path,f.size,f.md5,f.crc32,chunk_size)
+            futures[future] = f.name
+        for future in as_completed(futures):
+            try:
+                transferred = future.result()
+            except (requests.exceptions.RequestException,OSError) as e:
+                print('failed to download ' + futures[future] + ': ' + str(e))
+                summary['failed'] += 1
+                continue
+            if transferred == 0:
+                summary['skipped'] += 1
+            else:
+                summary['downloaded'] += 1
+                summary['bytes'] += transferred
+    summary['seconds'] = time.time() - start
+    summary['throughput'] = summary['bytes']/summary['seconds'] if summary['seconds'] > 0 else 0.
+    print('Downloaded ' + format_size(summary['bytes']) + ' in ' + str(round(summary['seconds'],1)) + 
+          ' s (' + format_size(summary['throughput']) + '/s); ' + str(summary['skipped']) + 
+          ' skipped, ' + str(summary['failed']) + ' failed')
+    return summary
+
+def store_path(f,store_dir=STORE_DIR):
+    """
+    store_path returns the path of a planned file in the content-addressed store 
+    (store_dir/md5/ab/abcdef... or store_dir/crc32/ab/abcdef..._size), or None if the 
+    manifest did not provide a checksum for it
+    """
+    if f.md5:
+        digest = f.md5.lower()
+        return os.path.join(store_dir,'md5',digest[:2],digest)
+    if f.crc32:
+        digest = f.crc32.lower().replace('0x','').zfill(8)
+        return os.path.join(store_dir,'crc32',digest[:2],digest + '_' + str(f.size))
+    return None
+
+def materialize(source,target,link='hard'):
+    """
+    materialize makes target point to the store object source with a hard link or a 
+    symbolic link (link='hard' or 'symlink'), falling back to a symlink and then a copy
+    if the file system does not support the requested link type
+    """
+    if os.path.lexists(target):
+        if os.path.exists(target) and os.path.samefile(source,target):
+            return
+        os.remove(target)
+    if link == 'hard':
+        try:
+            os.link(source,target)
+            return
+        except OSError:
+            pass
+    try:
+        os.symlink(os.path.abspath(source),target)
+    except OSError:
+        shutil.copy2(source,target)
+
+def get_store_size(store_dir=STORE_DIR):
+    # total size in bytes of the objects in the store
+    size = 0
+    for root, dirs, files in os.walk(store_dir):
+        size += sum(os.path.getsize(os.path.join(root,name)) for name in files if not name.endswith('.part'))
     return size
 
-def download_aop_files(product,site,year=None,download_folder='./data',match_string=None,check_size=True):
+def evict_store(quota,store_dir=STORE_DIR,keep=()):
+    """
+    evict_store removes the least recently used objects (oldest modification time, which 
+    is updated each time an object is materialized) until the store is smaller than quota
+    bytes. Objects in keep are never removed. Hard linked copies in download folders keep
+    their data on disk until they are also deleted; symbolic links to evicted objects break.
+    --------
+     Returns:
+         number of bytes removed from the store
+    """
+    objects = []
+    for root, dirs, files in os.walk(store_dir):
+        for name in files:
+            if not name.endswith('.part'):
+                path = os.path.join(root,name)
+                stat = os.stat(path)
+                objects.append((stat.st_mtime,stat.st_size,path))
+    size = sum(o[1] for o in objects)
+    keep = set(os.path.abspath(k) for k in keep)
+    removed = 0
+    for mtime, obj_size, path in sorted(objects):
+        if size - removed <= quota:
+            break
+        if os.path.abspath(path) not in keep:
+            os.remove(path)
+            removed += obj_size
+    return removed
+
+def download_files_to_store(plan,store_dir=STORE_DIR,quota=None,link='hard',max_workers=4,chunk_size=CHUNK_SIZE):
+    """
+    download_files_to_store downloads each distinct file in a download plan once into a 
+    content-addressed store and materializes it at its planned path with a link, so files 
+    already in the store (from another project, year filter, or folder layout) are not 
+    downloaded again. Files without a checksum in the manifest are downloaded directly.
+    --------
+     Inputs:
+         plan: list of PlannedFile, eg. from plan_download
+         store_dir: folder of the content-addressed store; default STORE_DIR (~/.neon_aop_store)
+         quota: maximum size of the store in bytes, least recently used objects are evicted 
+                after the download; default None (no limit)
+         link: 'hard' or 'symlink'; default 'hard'
+         max_workers: number of files downloaded at the same time; default 4
+         chunk_size: number of bytes read and written at a time; default CHUNK_SIZE (4 MiB)
+    --------
+     Returns:
+         download_files summary dictionary, with the number of 'linked' files added
+    --------
+    Usage:
+    --------
+    plan = plan_download(urls,'./data/JORN_2019/CHM')
+    download_files_to_store(plan,quota=500*10**9)
+    """
+    store_plan = {}
+    direct_plan = []
+    for f in plan:
+        obj = store_path(f,store_dir)
+        if obj is None:
+            direct_plan.append(f)
+        elif obj not in store_plan:
+            store_plan[obj] = f._replace(path=obj)
+    
+    summary = download_files(list(store_plan.values()) + direct_plan,max_workers=max_workers,chunk_size=chunk_size)
+    
+    summary['linked'] = 0
+    for f in plan:
+        obj = store_path(f,store_dir)
+        if obj is None or not os.path.exists(obj):
+            continue
+        folder = os.path.dirname(f.path)
+        if folder and not os.path.exists(folder):
+            os.makedirs(folder,exist_ok=True)
+        materialize(obj,f.path,link)
+        os.utime(obj) # mark as recently used
+        summary['linked'] += 1
+    
+    if quota is not None:
+        evict_store(quota,store_dir,keep=store_plan.keys())
+    return summary
+
+def get_plan_size(plan):
+    # total size in bytes of the files in a download plan
+    size = sum(f.size for f in plan)
+    print('Download size:',format_size(size))
+    return size
+
+def get_file_size(urls,match_string):
+    return get_plan_size(plan_download(urls,'.',match_string))
+
+def download_aop_files(product,site,year=None,download_folder='./data',match_string=None,check_size=True,max_workers=4,
+                       store_dir=None,store_quota=None):
     """
     download_aop_files downloads NEON AOP files from the AOP for a given data product, site, and 
     optional year, download folder, and 
@@ -118,6 +535,10 @@ def download_aop_files(product,site,year=None,download_folder='./data',match_str
              download_folder: folder to store downloaded files; default (./data) in current directory
              match_string: subset of data to match, need to use exact pattern for file name
              check_size: prompt to continue download (y/n) after displaying size; default = True
+             max_workers: number of files downloaded at the same time; default = 4
+             store_dir: content-addressed store to download into and hard link from, so repeated 
+                        pulls of the same files are local link operations; default None (no store)
+             store_quota: maximum size of the store in bytes; default None (no limit)
     --------
     Usage:
     --------
@@ -134,8 +555,9 @@ def download_aop_files(product,site,year=None,download_folder='./data',match_str
     if not os.path.exists(download_folder):
         os.makedirs(download_folder)
     
-    #get the size of all the files you are planning to download
-    size = get_file_size(urls,match_string)
+    #plan the download (month manifests are fetched concurrently) and display its total size
+    plan = plan_download(urls,download_folder,match_string)
+    get_plan_size(plan)
     
     #prompt to continue with download after displaying the file size
     if check_size:
@@ -143,20 +565,155 @@ def download_aop_files(product,site,year=None,download_folder='./data',match_str
             print('Exiting download_aop_files')
             return
     
-    #download files in the urls
-    for url in urls:
-        r = requests.get(url)
-        files = r.json()['data']['files']
-        for i in range(len(files)):
-            if match_string is not None:
-                if match_string in files[i]['name']:
-                    print('downloading ' + files[i]['name'] + ' to ' + download_folder)
-                    try:
-                        download_file(files[i]['url'],os.path.join(download_folder,files[i]['name']))
-                    except requests.exceptions.RequestException as e:
-                        print(e)
-            else:
-                try:
-                    download_file(files[i]['url'],os.path.join(download_folder,files[i]['name']))
-                except requests.exceptions.RequestException as e:
-                    print(e)
\ No newline at end of file
+    #download files in the plan; partially downloaded files are resumed and complete ones skipped
+    if store_dir is not None:
+        return download_files_to_store(plan,store_dir,store_quota,max_workers=max_workers)
+    return download_files(plan,max_workers=max_workers)
+
+def tile_coordinates(file_name):
+    """
+    tile_coordinates returns the (easting, northing) of the lower left corner of the tile 
+    in an AOP file name, or None if the name does not contain tile coordinates
+    --------
+    Usage:
+    --------
+    tile_coordinates('NEON_D14_JORN_DP3_314000_3610000_CHM.tif') # (314000, 3610000)
+    """
+    match = _tile_pattern.search(file_name)
+    if match is None:
+        return None
+    return int(match.group(1)), int(match.group(2))
+
+def build_tile_index(plan):
+    """
+    build_tile_index groups the files of a download plan by tile, returning a dictionary 
+    {(easting, northing): [PlannedFile, ...]}. Files without tile coordinates in their 
+    name (eg. kml or metadata files) are left out.
+    """
+    index = {}
+    for f in plan:
+        tile = tile_coordinates(f.name)
+        if tile is not None:
+            index.setdefault(tile,[]).append(f)
+    return index
+
+def tiles_in_bbox(bbox,tile_size=TILE_SIZE):
+    """
+    tiles_in_bbox returns the set of (easting, northing) tiles intersecting a bounding box 
+    (xmin, ymin, xmax, ymax) given in the UTM coordinates of the site; tiles that only 
+    touch the edge of the box are not included
+    """
+    xmin, ymin, xmax, ymax = bbox
+    x0, y0 = int(math.floor(xmin/tile_size)), int(math.floor(ymin/tile_size))
+    x1, y1 = max(x0+1,int(math.ceil(xmax/tile_size))), max(y0+1,int(math.ceil(ymax/tile_size)))
+    return set((i*tile_size,j*tile_size) for i in range(x0,x1) for j in range(y0,y1))
+
+def tiles_for_points(points,tile_size=TILE_SIZE):
+    """
+    tiles_for_points returns the set of (easting, northing) tiles containing a list of 
+    (easting, northing) points, eg. plot centroids
+    """
+    return set((int(math.floor(x/tile_size))*tile_size,int(math.floor(y/tile_size))*tile_size) 
+               for x, y in points)
+
+def tiles_for_geometry(geometry,epsg=None,tile_size=TILE_SIZE):
+    """
+    tiles_for_geometry returns the set of (easting, northing) tiles intersecting a 
+    geometry, which can be a shapefile or GeoJSON path, a geopandas GeoDataFrame / 
+    GeoSeries, or a shapely geometry. Points and lines on a tile edge are assigned to 
+    tiles as in tiles_for_points. Requires shapely (and geopandas for files and 
+    data frames).
+    --------
+     Inputs:
+         geometry: path to a shapefile or GeoJSON, GeoDataFrame, GeoSeries, or shapely geometry
+         epsg: EPSG code of the site's UTM zone (eg. 32613 for JORN); if given, files and 
+               data frames are reprojected to it first; default None (already in UTM)
+         tile_size: tile size in meters; default TILE_SIZE (1000)
+    --------
+    Usage:
+    --------
+    tiles = tiles_for_geometry('./shp/study_area.shp',epsg=32613)
+    """
+    from shapely.geometry import box, LineString
+    if isinstance(geometry,str):
+        import geopandas as gpd
+        geometry = gpd.read_file(geometry)
+    if hasattr(geometry,'to_crs'): # GeoDataFrame or GeoSeries
+        if epsg is not None:
+            geometry = geometry.to_crs(epsg=epsg)
+        #union_all replaces the deprecated unary_union in geopandas >= 1.0
+        geometry = geometry.union_all() if hasattr(geometry,'union_all') else geometry.unary_union
+    tiles = set()
+    if geometry.area > 0:
+        #polygons: tiles that only touch the edge of the geometry are not included
+        for tile in tiles_in_bbox(geometry.bounds,tile_size):
+            tile_box = box(tile[0],tile[1],tile[0]+tile_size,tile[1]+tile_size)
+            if geometry.intersects(tile_box) and not geometry.touches(tile_box):
+                tiles.add(tile)
+        return tiles
+    #points and lines: as in tiles_for_points, a tile holds its left and bottom edges but not 
+    #its right and top edges, so points and lines on tile edges belong to exactly one tile
+    xmin, ymin, xmax, ymax = geometry.bounds
+    for i in range(int(math.floor(xmin/tile_size)),int(math.floor(xmax/tile_size))+1):
+        for j in range(int(math.floor(ymin/tile_size)),int(math.floor(ymax/tile_size))+1):
+            x0, y0, x1, y1 = i*tile_size, j*tile_size, (i+1)*tile_size, (j+1)*tile_size
+            inside = geometry.intersection(box(x0,y0,x1,y1))
+            if not inside.is_empty and not inside.difference(LineString([(x0,y1),(x1,y1),(x1,y0)])).is_empty:
+                tiles.add((x0,y0))
+    return tiles
+
+def query_tile_index(index,tiles):
+    """
+    query_tile_index returns the download plan for the files in a tile index (from 
+    build_tile_index) that belong to a set of (easting, northing) tiles
+    """
+    return [f for tile in sorted(tiles) for f in index.get(tile,[])]
+
+def plan_tile_download(products,site,year=None,download_folder='./data',bbox=None,points=None,
+                       geometry=None,epsg=None,tile_size=TILE_SIZE):
+    """
+    plan_tile_download returns a single download plan with only the tiles that intersect 
+    a bounding box, list of points, and/or geometry, across one or more AOP mosaic data 
+    products. Files for each product are stored in a download_folder/<product> sub-folder.
+    --------
+     Inputs:
+         required:
+             products: data product code or list of codes (eg. ['DP3.30015.001','DP3.30024.001'] - CHM, DEM)
+             site: the 4-digit NEON site code (eg. 'SRER', 'JORN')
+         
+         optional:
+             year: year (eg. '2020'); default (None) is all years
+             download_folder: folder to store downloaded files; default (./data) in current directory
+             bbox: (xmin, ymin, xmax, ymax) in UTM coordinates; default None
+             points: list of (easting, northing) UTM coordinates; default None
+             geometry: shapefile / GeoJSON path or geometry, see tiles_for_geometry; default None
+             epsg: EPSG code of the site's UTM zone used to reproject geometry; default None
+             tile_size: tile size in meters; default TILE_SIZE (1000)
+    --------
+    Usage:
+    --------
+    plan = plan_tile_download(['DP3.30015.001','DP3.30024.001','DP3.30006.001'],'JORN','2019',
+                              './data/JORN_2019',bbox=(314200,3610100,315600,3610900))
+    get_plan_size(plan)
+    download_files(plan)
+    """
+    if isinstance(products,str):
+        products = [products]
+    
+    tiles = set()
+    if bbox is not None:
+        tiles |= tiles_in_bbox(bbox,tile_size)
+    if points is not None:
+        tiles |= tiles_for_points(points,tile_size)
+    if geometry is not None:
+        tiles |= tiles_for_geometry(geometry,epsg,tile_size)
+    
+    plan = []
+    for product in products:
+        if year is not None:
+            urls = list_available_urls_by_year(product,site,year)
+        else:
+            urls = list_available_urls(product,site)
+        index = build_tile_index(plan_download(urls or [],os.path.join(download_folder,product)))
+        plan.extend(query_tile_index(index,tiles))
+    return plan
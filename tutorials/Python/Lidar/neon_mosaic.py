@@ -0,0 +1,196 @@
+# -*- coding: utf-8 -*-
+"""
+In-process mosaicking of NEON AOP L3 GeoTIFF tiles (eg. DTM, CHM, aspect).
+
+merge_lidar_geotiff_files_py runs gdal_merge.py in a subprocess and then reads the whole mosaic
+back. Here a mosaic index is built from the tile headers only (extent, pixel size, no data, data
+type), and the output is produced block by block: for each output block only the windows of the
+tiles overlapping it are read and combined with an overlap rule (last as gdal_merge.py, first, mean, min, max).
+Blocks are processed in parallel by a process pool and written to a tiled, compressed GeoTIFF
+with neon_raster_io.
+"""
+
+import glob
+import numpy as np
+from collections import namedtuple
+from concurrent.futures import ProcessPoolExecutor
+from osgeo import gdal
+from neon_raster_io import GDAL_TO_NUMPY, create_raster, build_overviews
+
+RULES = ('first','last','mean','min','max')
+
+#tile in the mosaic grid: its pixel offset in the mosaic and its size
+MosaicTile = namedtuple('MosaicTile',['filename','col_off','row_off','cols','rows','no_data'])
+
+def build_mosaic_index(filenames):
+    """
+    build_mosaic_index reads the header of each tile and returns a dictionary with the mosaic
+    geotransform, projection, cols, rows, bands, dtype and the list of MosaicTile; all tiles
+    must have the same pixel size, number of bands, data type and projection and lie on the
+    same pixel grid (as NEON L3 tiles do)
+    --------
+    Usage:
+    --------
+    index = build_mosaic_index(glob.glob('./TEAK_Aspect_Tiles/*_aspect.tif'))
+    """
+    headers = []
+    for filename in filenames:
+        dataset = gdal.Open(filename)
+        band = dataset.GetRasterBand(1)
+        headers.append((filename,dataset.GetGeoTransform(),dataset.RasterXSize,dataset.RasterYSize,
+                        band.GetNoDataValue(),band.DataType,dataset.RasterCount,dataset.GetProjection()))
+        dataset = None
+    if not headers:
+        raise ValueError('no tiles to mosaic')
+    pixel_width, pixel_height = headers[0][1][1], headers[0][1][5]
+    first_file, first_type, first_bands, first_projection = [headers[0][i] for i in (0,5,6,7)]
+    for filename, geotransform, cols, rows, no_data, data_type, bands, projection in headers:
+        if not (np.isclose(geotransform[1],pixel_width) and np.isclose(geotransform[5],pixel_height)):
+            raise ValueError(filename + ' has pixel size ' + str((geotransform[1],geotransform[5])) +
+                             ', expected ' + str((pixel_width,pixel_height)))
+        if bands != first_bands:
+            raise ValueError(filename + ' has ' + str(bands) + ' bands, ' + first_file + ' has ' + str(first_bands))
+        if data_type != first_type:
+            raise ValueError(filename + ' has data type ' + gdal.GetDataTypeName(data_type) + ', ' + first_file +
+                             ' has ' + gdal.GetDataTypeName(first_type))
+        if projection != first_projection:
+            raise ValueError(filename + ' has a different projection than ' + first_file)
+    xmin = min(h[1][0] for h in headers)
+    ymax = max(h[1][3] for h in headers)
+    xmax = max(h[1][0] + h[2]*pixel_width for h in headers)
+    ymin = min(h[1][3] + h[3]*pixel_height for h in headers)
+    tiles = [MosaicTile(filename,int(round((geotransform[0] - xmin)/pixel_width)),
+                        int(round((geotransform[3] - ymax)/pixel_height)),cols,rows,no_data)
+             for filename, geotransform, cols, rows, no_data, data_type, bands, projection in headers]
+    return {'geotransform':(xmin,pixel_width,0,ymax,0,pixel_height),
+            'projection':headers[0][7],
+            'cols':int(round((xmax - xmin)/pixel_width)),
+            'rows':int(round((ymin - ymax)/pixel_height)),
+            'bands':headers[0][6],
+            'dtype':GDAL_TO_NUMPY.get(headers[0][5],np.float64),
+            'tiles':tiles}
+
+def mosaic_windows(cols,rows,block_size=1024):
+    # (xoff, yoff, xsize, ysize) output blocks of block_size x block_size
+    for yoff in range(0,rows,block_size):
+        for xoff in range(0,cols,block_size):
+            yield (xoff,yoff,min(block_size,cols-xoff),min(block_size,rows-yoff))
+
+def overlapping_tiles(tiles,window):
+    """
+    overlapping_tiles returns [(tile, tile window, output window)] for the tiles that overlap
+    an output window (xoff, yoff, xsize, ysize), with both windows as (xoff, yoff, xsize, ysize)
+    """
+    xoff, yoff, xsize, ysize = window
+    overlaps = []
+    for tile in tiles:
+        x0, x1 = max(xoff,tile.col_off), min(xoff+xsize,tile.col_off+tile.cols)
+        y0, y1 = max(yoff,tile.row_off), min(yoff+ysize,tile.row_off+tile.rows)
+        if x0 < x1 and y0 < y1:
+            overlaps.append((tile,(x0-tile.col_off,y0-tile.row_off,x1-x0,y1-y0),(x0-xoff,y0-yoff,x1-x0,y1-y0)))
+    return overlaps
+
+def combine_block(arrays,rule='last'):
+    """
+    combine_block combines a list of (rows, columns, bands) float arrays (NaN is no data, in
+    tile order) with an overlap rule: 'first' or 'last' valid value, 'mean', 'min' or 'max'
+    """
+    out = np.full(arrays[0].shape,np.nan)
+    if rule == 'mean':
+        count = np.zeros(out.shape)
+        total = np.zeros(out.shape)
+        for array in arrays:
+            valid = ~np.isnan(array)
+            total[valid] += array[valid]
+            count += valid
+        with np.errstate(invalid='ignore',divide='ignore'):
+            return total/np.where(count > 0,count,np.nan)
+    for array in arrays:
+        if rule == 'first':
+            fill = np.isnan(out)
+            out[fill] = array[fill]
+        elif rule == 'last':
+            valid = ~np.isnan(array)
+            out[valid] = array[valid]
+        elif rule == 'min':
+            out = np.fmin(out,array)
+        elif rule == 'max':
+            out = np.fmax(out,array)
+        else:
+            raise ValueError('rule must be one of ' + str(RULES) + ', not ' + repr(rule))
+    return out
+
+def _mosaic_block(args):
+    # worker: read the parts of the tiles that overlap one output block and combine them
+    window, overlaps, bands, rule, no_data, dtype = args
+    xoff, yoff, xsize, ysize = window
+    arrays = []
+    for tile, (tx, ty, tw, th), (ox, oy, ow, oh) in overlaps:
+        dataset = gdal.Open(tile.filename)
+        array = np.full((ysize,xsize,bands),np.nan)
+        for band in range(bands):
+            values = dataset.GetRasterBand(band+1).ReadAsArray(tx,ty,tw,th).astype(np.float64)
+            if tile.no_data is not None:
+                values[values == tile.no_data] = np.nan
+            array[oy:oy+oh,ox:ox+ow,band] = values
+        dataset = None
+        arrays.append(array)
+    if arrays:
+        out = combine_block(arrays,rule)
+    else:
+        out = np.full((ysize,xsize,bands),np.nan)
+    if np.dtype(dtype).kind != 'f':
+        out = np.rint(out)
+    out[np.isnan(out)] = no_data
+    return window, out.astype(dtype)
+
+def mosaic_tiles(filenames,out_filename,rule='last',no_data=None,block_size=1024,overviews=False,
+                 max_workers=None):
+    """
+    mosaic_tiles mosaics GeoTIFF tiles into a tiled, compressed GeoTIFF without loading them,
+    one output block at a time in parallel
+    --------
+     Inputs:
+         filenames: list of GeoTIFF tiles, or a glob pattern
+         out_filename: mosaic GeoTIFF filename
+         rule: value where tiles overlap: 'last' (default, as gdal_merge.py, which copies each
+               tile over the previous ones: the last valid value in the list wins), 'first',
+               'mean', 'min' or 'max'
+         no_data: output no data value; default None (no data of the first tile, or NaN for
+                  float rasters and 0 for integer rasters if it has none)
+         block_size: output block size (pixels); default 1024, a multiple of the 256 pixel tiles
+         overviews: build internal overviews; default False
+         max_workers: number of processes; default None (number of CPUs)
+    --------
+     Returns:
+         mosaic index (see build_mosaic_index)
+    --------
+    Usage:
+    --------
+    mosaic_tiles('/Users/olearyd/Git/data/TEAK_Aspect_Tiles/*_aspect.tif','TEAK_Aspect_Mosaic.tif')
+    TEAK_aspect_array, TEAK_aspect_metadata = raster2array('TEAK_Aspect_Mosaic.tif')
+    """
+    if rule not in RULES:
+        raise ValueError('rule must be one of ' + str(RULES) + ', not ' + repr(rule))
+    if isinstance(filenames,str):
+        filenames = sorted(glob.glob(filenames))
+    index = build_mosaic_index(filenames)
+    dtype = index['dtype'] if rule != 'mean' else np.result_type(index['dtype'],np.float32)
+    if no_data is None:
+        no_data = index['tiles'][0].no_data
+    if no_data is None:
+        no_data = np.nan if np.dtype(dtype).kind == 'f' else 0
+
+    dataset = create_raster(out_filename,index['cols'],index['rows'],index['bands'],dtype,index['geotransform'],
+                            projection=index['projection'],no_data=no_data)
+    args = [(window,overlapping_tiles(index['tiles'],window),index['bands'],rule,no_data,dtype)
+            for window in mosaic_windows(index['cols'],index['rows'],block_size)]
+    with ProcessPoolExecutor(max_workers=max_workers) as executor:
+        for (xoff, yoff, xsize, ysize), block in executor.map(_mosaic_block,args):
+            for band in range(index['bands']):
+                dataset.GetRasterBand(band+1).WriteArray(block[:,:,band],xoff,yoff)
+    if overviews:
+        build_overviews(dataset)
+    dataset.FlushCache()
+    dataset = None
+    return index
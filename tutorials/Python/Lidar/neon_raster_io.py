@@ -0,0 +1,355 @@
+# -*- coding: utf-8 -*-
+"""
+Shared GeoTIFF reading and writing functions for the NEON lidar tutorials.
+
+The raster2array copies in the lidar tutorials read the whole band with
+ReadAsArray(0,0,cols,rows).astype(np.float) (a float64 copy) and call GetStatistics(True,True),
+which scans the whole raster before it is read. Here the raster is read in windows aligned to
+its native blocks (tiles, or strips of full rows), directly into a preallocated array of the
+native dtype, or float32 when no data values are set to NaN and the scale factor is applied.
+Statistics are computed from the blocks as they are read, and only when requested.
+
+The array2raster copies create a single-band, striped, uncompressed GTiff with a hardcoded data
+type and write it with one WriteArray call. Here the GDAL data type follows the array dtype, the
+output is tiled (or a Cloud Optimized GeoTIFF) with DEFLATE or ZSTD compression and the
+predictor that suits the data type, multi-band arrays are written as one band each, blocks can
+be written as they are produced by a generator, and overviews can be built.
+
+raster2array and array2raster take the same arguments as the tutorial functions, so they can be
+used in their place:
+
+    import sys; sys.path.append('../..')
+    from neon_raster_io import raster2array, array2raster
+    chm_array, chm_metadata = raster2array(chm_file)
+"""
+
+import os
+import numpy as np
+from osgeo import gdal, osr
+
+#window size (pixels) used when grouping native blocks into read windows
+WINDOW_PIXELS = 1 << 22
+
+GDAL_TO_NUMPY = {gdal.GDT_Byte:np.uint8, gdal.GDT_UInt16:np.uint16, gdal.GDT_Int16:np.int16,
+                 gdal.GDT_UInt32:np.uint32, gdal.GDT_Int32:np.int32,
+                 gdal.GDT_Float32:np.float32, gdal.GDT_Float64:np.float64}
+
+NUMPY_TO_GDAL = {np.dtype(numpy_type):gdal_type for gdal_type, numpy_type in GDAL_TO_NUMPY.items()}
+NUMPY_TO_GDAL[np.dtype(bool)] = gdal.GDT_Byte
+NUMPY_TO_GDAL[np.dtype(np.int8)] = gdal.GDT_Int16
+NUMPY_TO_GDAL[np.dtype(np.int64)] = gdal.GDT_Float64
+NUMPY_TO_GDAL[np.dtype(np.uint64)] = gdal.GDT_Float64
+
+def raster_metadata(dataset):
+    """
+    raster_metadata returns the metadata dictionary of the tutorial raster2array (array_rows,
+    array_cols, bands, driver, projection, geotransform, pixelWidth, pixelHeight, ext_dict,
+    extent, and noDataValue and scaleFactor of band 1), plus dataType (numpy dtype of band 1)
+    and blockSize ((columns, rows) of the native blocks)
+    """
+    metadata = {}
+    metadata['array_rows'] = dataset.RasterYSize
+    metadata['array_cols'] = dataset.RasterXSize
+    metadata['bands'] = dataset.RasterCount
+    metadata['driver'] = dataset.GetDriver().LongName
+    metadata['projection'] = dataset.GetProjection()
+    metadata['geotransform'] = dataset.GetGeoTransform()
+
+    mapinfo = dataset.GetGeoTransform()
+    metadata['pixelWidth'] = mapinfo[1]
+    metadata['pixelHeight'] = mapinfo[5]
+
+    metadata['ext_dict'] = {}
+    metadata['ext_dict']['xMin'] = mapinfo[0]
+    metadata['ext_dict']['xMax'] = mapinfo[0] + dataset.RasterXSize*mapinfo[1]
+    metadata['ext_dict']['yMin'] = mapinfo[3] + dataset.RasterYSize*mapinfo[5]
+    metadata['ext_dict']['yMax'] = mapinfo[3]
+
+    metadata['extent'] = (metadata['ext_dict']['xMin'],metadata['ext_dict']['xMax'],
+                          metadata['ext_dict']['yMin'],metadata['ext_dict']['yMax'])
+
+    raster = dataset.GetRasterBand(1)
+    metadata['noDataValue'] = raster.GetNoDataValue()
+    metadata['scaleFactor'] = raster.GetScale()
+    metadata['dataType'] = GDAL_TO_NUMPY.get(raster.DataType,np.float64)
+    metadata['blockSize'] = tuple(raster.GetBlockSize())
+    return metadata
+
+def raster_windows(dataset,max_pixels=WINDOW_PIXELS):
+    """
+    raster_windows yields (xoff, yoff, xsize, ysize) windows of full rows whose height is a
+    multiple of the native block height, with about max_pixels pixels each, so every native
+    block (tile or strip) is read exactly once
+    """
+    block_cols, block_rows = dataset.GetRasterBand(1).GetBlockSize()
+    cols, rows = dataset.RasterXSize, dataset.RasterYSize
+    height = block_rows*max(1,max_pixels//(cols*block_rows))
+    for yoff in range(0,rows,height):
+        yield (0,yoff,cols,min(height,rows-yoff))
+
+def _mask_block(block,no_data,scale,float_output):
+    # set no data to NaN and apply the scale factor in place (float), or return the no data mask (native)
+    if no_data is None:
+        mask = None
+    elif np.isnan(no_data):
+        mask = np.isnan(block)
+    else:
+        mask = block == np.asarray(no_data).astype(block.dtype)
+    if float_output:
+        if mask is not None:
+            block[mask] = np.nan
+        if scale not in (None,1):
+            block /= scale
+    return mask
+
+def _new_stats():
+    return {'count':0,'min':np.inf,'max':-np.inf,'sum':0.,'sum_sq':0.}
+
+def _update_stats(stats,block,mask):
+    values = block[~mask] if mask is not None else block.ravel()
+    if values.dtype.kind == 'f':
+        values = values[~np.isnan(values)]
+    if values.size == 0:
+        return
+    values = values.astype(np.float64)
+    stats['count'] += values.size
+    stats['min'] = min(stats['min'],values.min())
+    stats['max'] = max(stats['max'],values.max())
+    stats['sum'] += values.sum()
+    stats['sum_sq'] += np.dot(values,values)
+
+def _band_stats(stats):
+    # same keys and rounding as the tutorial bandstats (GetStatistics)
+    if stats['count'] == 0:
+        return {'min':np.nan,'max':np.nan,'mean':np.nan,'stdev':np.nan}
+    mean = stats['sum']/stats['count']
+    stdev = np.sqrt(max(stats['sum_sq']/stats['count'] - mean**2,0))
+    return {'min':round(float(stats['min']),2),'max':round(float(stats['max']),2),
+            'mean':round(float(mean),2),'stdev':round(float(stdev),2)}
+
+def iter_raster_blocks(geotif_file,band=1,dtype=np.float32,max_pixels=WINDOW_PIXELS):
+    """
+    iter_raster_blocks yields (window, block) for each window of raster_windows, where window
+    is (xoff, yoff, xsize, ysize); with a float dtype no data is NaN and the scale factor is
+    applied, with dtype=None blocks are masked arrays of the native dtype
+    --------
+    Usage:
+    --------
+    for (xoff,yoff,xsize,ysize), block in iter_raster_blocks(chm_file):
+        n_trees += np.count_nonzero(block > 2)
+    """
+    dataset = gdal.Open(geotif_file)
+    raster = dataset.GetRasterBand(band)
+    no_data, scale = raster.GetNoDataValue(), raster.GetScale()
+    float_output = dtype is not None and np.dtype(dtype).kind == 'f'
+    for window in raster_windows(dataset,max_pixels):
+        block = np.empty((window[3],window[2]),dtype=dtype or GDAL_TO_NUMPY.get(raster.DataType,np.float64))
+        raster.ReadAsArray(*window,buf_obj=block)
+        mask = _mask_block(block,no_data,scale,float_output)
+        if not float_output and mask is not None:
+            block = np.ma.MaskedArray(block,mask=mask)
+        yield window, block
+    dataset = None
+
+def raster2array(geotif_file,band=1,dtype=np.float32,stats=False,max_pixels=WINDOW_PIXELS):
+    """
+    raster2array reads a GeoTIFF band (or all bands) block by block into an array
+    --------
+     Inputs:
+         geotif_file: GeoTIFF filename
+         band: band number (1-based), or None for all bands as (rows, columns, bands); default 1
+         dtype: np.float32 (default) or np.float64 to set no data to NaN and divide by the scale
+                factor, as the tutorial function; None to keep the native dtype, in which case a
+                numpy masked array is returned with no data masked and the scale not applied
+         stats: compute min, max, mean and stdev (metadata['bandstats']) of the returned values
+                from the blocks as they are read; default False
+         max_pixels: approximate number of pixels read at a time; default WINDOW_PIXELS
+    --------
+     Returns:
+         array, metadata (see raster_metadata); for band=None, metadata['bandstats'] is a list
+    --------
+    Usage:
+    --------
+    chm_array, chm_metadata = raster2array('NEON_D17_TEAK_DP3_320000_4092000_CHM.tif',stats=True)
+    """
+    dataset = gdal.Open(geotif_file)
+    metadata = raster_metadata(dataset)
+    band_numbers = list(range(1,dataset.RasterCount+1)) if band is None else [band]
+    float_output = dtype is not None and np.dtype(dtype).kind == 'f'
+    out_dtype = dtype or metadata['dataType']
+    rows, cols = metadata['array_rows'], metadata['array_cols']
+    array = np.empty((len(band_numbers),rows,cols),dtype=out_dtype)
+    mask = np.zeros(array.shape,dtype=bool) if not float_output else None
+    band_stats = []
+    for i, band_number in enumerate(band_numbers):
+        raster = dataset.GetRasterBand(band_number)
+        no_data, scale = raster.GetNoDataValue(), raster.GetScale()
+        block_stats = _new_stats()
+        for xoff, yoff, xsize, ysize in raster_windows(dataset,max_pixels):
+            block = array[i,yoff:yoff+ysize]
+            raster.ReadAsArray(xoff,yoff,xsize,ysize,buf_obj=block)
+            block_mask = _mask_block(block,no_data,scale,float_output)
+            if mask is not None and block_mask is not None:
+                mask[i,yoff:yoff+ysize] = block_mask
+            if stats:
+                _update_stats(block_stats,block,block_mask)
+        band_stats.append(_band_stats(block_stats))
+    dataset = None
+
+    if band is None:
+        array = np.moveaxis(array,0,2)
+        mask = np.moveaxis(mask,0,2) if mask is not None else None
+    else:
+        array = array[0]
+        mask = mask[0] if mask is not None else None
+    if mask is not None:
+        array = np.ma.MaskedArray(array,mask=mask)
+    if stats:
+        metadata['bandstats'] = band_stats if band is None else band_stats[0]
+    return array, metadata
+
+def numpy_to_gdal_type(dtype):
+    # GDAL data type for a numpy dtype; bool is written as Byte, int8 as Int16, 64-bit integers as Float64
+    return NUMPY_TO_GDAL[np.dtype(dtype)]
+
+def raster_creation_options(dtype,compress='DEFLATE',predictor=None,tiled=True,block_size=256):
+    """
+    raster_creation_options returns GTiff creation options
+    --------
+     Inputs:
+         dtype: numpy dtype of the raster
+         compress: 'DEFLATE' (default), 'ZSTD', 'LZW' or None
+         predictor: 1 (none), 2 (horizontal differencing) or 3 (floating point); default None
+                    (3 for float data, 2 for integer data)
+         tiled: tiled layout; default True
+         block_size: tile width and height; default 256
+    """
+    options = ['BIGTIFF=IF_SAFER']
+    if tiled:
+        options += ['TILED=YES','BLOCKXSIZE=' + str(block_size),'BLOCKYSIZE=' + str(block_size)]
+    if compress is not None:
+        if predictor is None:
+            predictor = 3 if np.dtype(dtype).kind == 'f' else 2
+        options += ['COMPRESS=' + compress,'PREDICTOR=' + str(predictor)]
+    return options
+
+def create_raster(filename,cols,rows,bands,dtype,geotransform,epsg=None,projection=None,no_data=None,
+                  options=None):
+    """
+    create_raster creates an empty GTiff raster and returns the gdal dataset
+    --------
+     Inputs:
+         filename: output GeoTIFF filename
+         cols, rows, bands: raster size
+         dtype: numpy dtype, mapped to the GDAL data type with numpy_to_gdal_type
+         geotransform: (originX, pixelWidth, 0, originY, 0, pixelHeight)
+         epsg: EPSG code, or projection: WKT string; default None
+         no_data: no data value set on every band; default None
+         options: GTiff creation options; default raster_creation_options(dtype)
+    """
+    if options is None:
+        options = raster_creation_options(dtype)
+    driver = gdal.GetDriverByName('GTiff')
+    dataset = driver.Create(filename,cols,rows,bands,numpy_to_gdal_type(dtype),options)
+    dataset.SetGeoTransform(geotransform)
+    if epsg is not None:
+        srs = osr.SpatialReference()
+        srs.ImportFromEPSG(int(epsg))
+        projection = srs.ExportToWkt()
+    if projection is not None:
+        dataset.SetProjection(projection)
+    if no_data is not None:
+        for band in range(bands):
+            dataset.GetRasterBand(band+1).SetNoDataValue(float(no_data))
+    return dataset
+
+def write_blocks(dataset,blocks):
+    """
+    write_blocks writes (xoff, yoff, block) items, eg. from a generator, to a gdal dataset;
+    block is (rows, columns) for a single-band raster or (rows, columns, bands)
+    """
+    for xoff, yoff, block in blocks:
+        if block.ndim == 2:
+            block = block[:,:,np.newaxis]
+        for band in range(block.shape[2]):
+            dataset.GetRasterBand(band+1).WriteArray(block[:,:,band],int(xoff),int(yoff))
+
+def overview_levels(cols,rows,block_size=256):
+    # overview factors 2, 4, 8, ... until the overview fits in one block
+    levels = []
+    factor = 2
+    while max(cols,rows)/factor >= block_size/2:
+        levels.append(factor)
+        factor *= 2
+    return levels
+
+def build_overviews(dataset,levels=None,resampling=None):
+    """
+    build_overviews builds internal overviews (levels default to overview_levels) with
+    AVERAGE resampling for float rasters and NEAREST for integer (eg. class) rasters
+    """
+    if levels is None:
+        levels = overview_levels(dataset.RasterXSize,dataset.RasterYSize)
+    if resampling is None:
+        dtype = GDAL_TO_NUMPY.get(dataset.GetRasterBand(1).DataType,np.float64)
+        resampling = 'AVERAGE' if np.dtype(dtype).kind == 'f' else 'NEAREST'
+    if levels:
+        dataset.BuildOverviews(resampling,levels)
+    return levels
+
+def array2raster(newRasterfn,rasterOrigin,pixelWidth,pixelHeight,array,epsg,no_data=None,dtype=None,
+                 compress='DEFLATE',predictor=None,tiled=True,block_size=256,overviews=False,cog=False,
+                 shape=None):
+    """
+    array2raster writes an array (or blocks from a generator) to a GeoTIFF
+    --------
+     Inputs:
+         newRasterfn: output GeoTIFF filename
+         rasterOrigin: (originX, originY) of the upper left corner
+         pixelWidth, pixelHeight: pixel size (pixelHeight is negative for north-up rasters)
+         array: (rows, columns) or (rows, columns, bands) array, or an iterable of
+                (xoff, yoff, block) items, in which case shape must be given
+         epsg: EPSG code
+         no_data: no data value; default None
+         dtype: output numpy dtype; default None (dtype of the array, float32 for blocks)
+         compress: 'DEFLATE' (default), 'ZSTD', 'LZW' or None; predictor: see raster_creation_options
+         tiled: tiled layout; default True; block_size: tile size; default 256
+         overviews: build internal overviews; default False
+         cog: write a Cloud Optimized GeoTIFF (tiled, with overviews) with the GDAL COG driver;
+              default False
+         shape: (rows, columns) or (rows, columns, bands) when array is an iterable of blocks
+    --------
+    Usage:
+    --------
+    array2raster('chm_classified.tif',(xMin,yMax),1,-1,chm_reclass.astype(np.uint8),32611,cog=True)
+    array2raster('chm_smooth.tif',(xMin,yMax),1,-1,smoothed_blocks(),32611,shape=(rows,cols))
+    """
+    if isinstance(array,np.ndarray):
+        shape = array.shape
+        blocks = [(0,0,array)]
+        dtype = array.dtype if dtype is None else dtype
+    else:
+        blocks = array
+        dtype = np.float32 if dtype is None else dtype
+    rows, cols = shape[0], shape[1]
+    bands = shape[2] if len(shape) == 3 else 1
+    geotransform = (rasterOrigin[0],pixelWidth,0,rasterOrigin[1],0,pixelHeight)
+
+    filename = newRasterfn + '.tmp.tif' if cog else newRasterfn
+    options = raster_creation_options(dtype,compress,predictor,tiled or cog,block_size)
+    dataset = create_raster(filename,cols,rows,bands,dtype,geotransform,epsg,no_data=no_data,options=options)
+    write_blocks(dataset,blocks)
+    if overviews and not cog:
+        build_overviews(dataset)
+    dataset.FlushCache()
+
+    if cog:
+        cog_options = ['BLOCKSIZE=' + str(block_size),'BIGTIFF=IF_SAFER',
+                       'OVERVIEW_RESAMPLING=' + ('AVERAGE' if np.dtype(dtype).kind == 'f' else 'NEAREST')]
+        if compress is not None:
+            cog_options += ['COMPRESS=' + compress,'PREDICTOR=YES']
+        gdal.GetDriverByName('COG').CreateCopy(newRasterfn,dataset,0,cog_options)
+        dataset = None
+        os.remove(filename)
+    dataset = None
+    return newRasterfn
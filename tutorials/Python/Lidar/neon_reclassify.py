@@ -0,0 +1,118 @@
+# -*- coding: utf-8 -*-
+"""
+Reclassification of rasters (eg. CHM height classes, north/south aspect) with a breakpoint
+table: one np.digitize pass and one lookup table pass per block.
+
+classify_raster_with_threshold-py copies the array and makes one np.where pass (with its own
+boolean temporaries) per class. Here interval rules are compiled once into sorted breakpoints
+and a lookup table of class values, so every pixel is classified by a single binary search,
+whatever the number of classes. Classes are written as uint8 (0 is unclassified / no data),
+and reclassify_raster processes a GeoTIFF block by block, so it can be larger than memory.
+
+A rule is (low, high, class value) for low <= x < high, or (low, high, class value, closure)
+with closure '[]', '[)', '(]' or '()'. low or high can be -np.inf / np.inf. If low > high the
+interval wraps around: x >= low or x <= high (for closure '[]'), eg. north facing aspect
+(315, 45, 1, '[]') when the raster has no negative values. Where rules overlap the first one wins.
+"""
+
+import numpy as np
+from osgeo import gdal
+from neon_raster_io import iter_raster_blocks, create_raster, raster_metadata
+
+#CHM classes of the tutorial: 0 m, 0-20 m, 20-40 m, > 40 m
+CHM_CLASSES = [(0,0,1,'[]'),(0,20,2,'(]'),(20,40,3,'(]'),(40,np.inf,4,'()')]
+
+#aspect classes of the tutorial: north (0-45 or >= 315), south (135-225); east and west unclassified
+ASPECT_NS_CLASSES = [(0,45,1,'[]'),(315,np.inf,1,'[]'),(135,225,2,'[]')]
+
+def _rule_intervals(rule):
+    # split a rule into (low, high, low inclusive, high inclusive, value) intervals, unwrapping low > high
+    low, high, value = rule[0], rule[1], rule[2]
+    closure = rule[3] if len(rule) > 3 else '[)'
+    low_closed, high_closed = closure[0] == '[', closure[1] == ']'
+    if low > high:
+        return [(low,np.inf,low_closed,False,value),(-np.inf,high,False,high_closed,value)]
+    return [(low,high,low_closed,high_closed,value)]
+
+def compile_rules(rules,dtype=np.float32,default=0):
+    """
+    compile_rules converts interval rules to a breakpoint table for reclassify: edges (sorted,
+    in the dtype of the data, so inclusive and exclusive bounds are exact) and a lookup table of
+    len(edges)+1 class values for the bins (-inf, e0], (e0, e1], ..., (e_last, inf)
+    --------
+     Inputs:
+         rules: list of rules (see module docstring), eg. CHM_CLASSES
+         dtype: dtype of the arrays that will be reclassified; default np.float32
+         default: value of pixels matched by no rule; default 0
+    """
+    dtype = np.dtype(dtype) if np.dtype(dtype).kind == 'f' else np.dtype(np.float64)
+    intervals = []
+    for rule in rules:
+        for low, high, low_closed, high_closed, value in _rule_intervals(rule):
+            # every interval becomes (low_edge, high_edge]
+            low_edge = dtype.type(low)
+            high_edge = dtype.type(high)
+            if low_closed and np.isfinite(low_edge):
+                low_edge = np.nextafter(low_edge,dtype.type(-np.inf))
+            if not high_closed and np.isfinite(high_edge):
+                high_edge = np.nextafter(high_edge,dtype.type(-np.inf))
+            intervals.append((low_edge,high_edge,value))
+    edges = np.unique([e for low_edge, high_edge, value in intervals
+                       for e in (low_edge,high_edge) if np.isfinite(e)]).astype(dtype)
+    if len(edges):
+        representatives = np.append(edges,np.nextafter(edges[-1],dtype.type(np.inf)))
+    else:
+        representatives = np.zeros(1,dtype=dtype)
+    lut = np.full(len(representatives),default,dtype=np.result_type(default,*[value for low_edge, high_edge, value in intervals]))
+    assigned = np.zeros(len(representatives),dtype=bool)
+    for low_edge, high_edge, value in intervals:
+        inside = (representatives > low_edge) & (representatives <= high_edge) & ~assigned
+        lut[inside] = value
+        assigned |= inside
+    return edges, lut
+
+def reclassify(array,edges,lut,no_data=0,dtype=np.uint8):
+    """
+    reclassify maps an array to class values with one np.digitize and one lookup table pass:
+    x <= edges[0] gets lut[0], edges[i-1] < x <= edges[i] gets lut[i], x > edges[-1] gets
+    lut[-1]; NaN gets no_data
+    --------
+    Usage:
+    --------
+    edges, lut = compile_rules(CHM_CLASSES)
+    chm_reclass = reclassify(chm_array,edges,lut)
+    """
+    classes = np.take(np.asarray(lut).astype(dtype),np.digitize(array,edges,right=True))
+    if np.asarray(array).dtype.kind == 'f':
+        classes[np.isnan(array)] = no_data
+    return classes
+
+def reclassify_rules(array,rules,default=0,no_data=0,dtype=np.uint8):
+    """
+    reclassify_rules reclassifies an array with interval rules, eg.
+    asp_reclass = reclassify_rules(aspect_array,ASPECT_NS_CLASSES)
+    """
+    edges, lut = compile_rules(rules,array.dtype,default)
+    return reclassify(array,edges,lut,no_data,dtype)
+
+def reclassify_raster(in_file,out_file,rules,default=0,no_data=0,dtype=np.uint8,max_pixels=1<<22):
+    """
+    reclassify_raster reclassifies band 1 of a GeoTIFF block by block (no data of the input
+    becomes no_data) and writes a tiled, compressed GeoTIFF of dtype (default uint8, no data 0)
+    --------
+    Usage:
+    --------
+    reclassify_raster('TEAK_Aspect_Mosaic.tif','TEAK_Aspect_NS.tif',ASPECT_NS_CLASSES)
+    """
+    dataset = gdal.Open(in_file)
+    metadata = raster_metadata(dataset)
+    dataset = None
+    edges, lut = compile_rules(rules,np.float32,default)
+    out = create_raster(out_file,metadata['array_cols'],metadata['array_rows'],1,dtype,metadata['geotransform'],
+                        projection=metadata['projection'],no_data=no_data)
+    band = out.GetRasterBand(1)
+    for (xoff, yoff, xsize, ysize), block in iter_raster_blocks(in_file,dtype=np.float32,max_pixels=max_pixels):
+        band.WriteArray(reclassify(block,edges,lut,no_data,dtype),xoff,yoff)
+    out.FlushCache()
+    out = None
+    return out_file
@@ -0,0 +1,152 @@
+# -*- coding: utf-8 -*-
+"""
+Slope, aspect, hillshade and multi-directional hillshade of NEON DTMs, computed over blocks of
+rows in parallel.
+
+hillshade() in create_hillshade_from_terrain_raster_py runs np.gradient over the whole DTM in
+float64 and keeps several full-size temporaries. Here the DTM is split into strips of rows,
+each read with a 1 pixel halo (the neighbours np.gradient needs at the strip edges) and
+processed in float32 by a process pool, and the results are written to tiled GeoTIFFs with
+neon_raster_io. Because np.gradient is central differences inside the raster and one-sided at
+its edges, the halo makes the block results identical to processing the whole mosaic at once:
+there are no seams at block boundaries.
+"""
+
+import numpy as np
+from concurrent.futures import ProcessPoolExecutor
+from osgeo import gdal
+from neon_raster_io import create_raster, raster_windows
+
+PRODUCTS = ('slope','aspect','hillshade','multidirectional')
+
+#azimuths (degrees) combined by the multi-directional hillshade
+MULTIDIRECTIONAL_AZIMUTHS = (225,270,315,360)
+
+def gradients(array,cell_size=(1,1)):
+    """
+    gradients returns (x, y) = np.gradient(array) in float32, as in the tutorial hillshade:
+    x along rows (towards the south), y along columns (towards the east), per unit distance
+    for cell_size = (row spacing, column spacing)
+    """
+    array = np.asarray(array,dtype=np.float32)
+    x, y = np.gradient(array,np.float32(cell_size[0]),np.float32(cell_size[1]))
+    return x, y
+
+def slope_degrees(x,y):
+    return np.degrees(np.arctan(np.sqrt(x*x + y*y)))
+
+def aspect_degrees(x,y):
+    # compass direction (0-360, clockwise from north) the slope faces; NaN where flat
+    aspect = np.degrees(np.arctan2(-y,x)) % 360
+    aspect[(x == 0) & (y == 0)] = np.nan
+    return aspect.astype(np.float32)
+
+def _shade(x,y,azimuth,angle_altitude):
+    # the tutorial hillshade, on precomputed gradients
+    azimuthrad = np.float32((360.0 - azimuth)*np.pi/180.)
+    altituderad = np.float32(angle_altitude*np.pi/180.)
+    slope = np.float32(np.pi/2.) - np.arctan(np.sqrt(x*x + y*y))
+    aspect = np.arctan2(-x,y)
+    shaded = np.sin(altituderad)*np.sin(slope) + \
+             np.cos(altituderad)*np.cos(slope)*np.cos((azimuthrad - np.float32(np.pi/2.)) - aspect)
+    return 255*(shaded + 1)/2
+
+def hillshade(array,azimuth,angle_altitude,cell_size=(1,1)):
+    """
+    hillshade returns the same shaded relief (0-255) as the tutorial function, computed in float32
+    --------
+    Usage:
+    --------
+    hs_array = hillshade(dtm_array,225,45)
+    """
+    x, y = gradients(array,cell_size)
+    return _shade(x,y,azimuth,angle_altitude)
+
+def multidirectional_hillshade(x,y,angle_altitude=45,azimuths=MULTIDIRECTIONAL_AZIMUTHS):
+    """
+    multidirectional_hillshade combines hillshades from several azimuths, each weighted by
+    sin^2 of the angle between it and the aspect, so every slope is lit from across its face
+    (similar to gdaldem hillshade -multidirectional); flat cells get equal weights
+    """
+    aspect = np.radians(aspect_degrees(x,y))
+    flat = np.isnan(aspect)
+    total = np.zeros(x.shape,dtype=np.float32)
+    weights = np.zeros(x.shape,dtype=np.float32)
+    for azimuth in azimuths:
+        w = np.sin(aspect - np.float32(np.radians(azimuth)))**2
+        w[flat] = 1
+        total += w*_shade(x,y,azimuth,angle_altitude)
+        weights += w
+    return total/weights
+
+def terrain_block(array,products=PRODUCTS,azimuth=315,angle_altitude=45,cell_size=(1,1)):
+    """
+    terrain_block computes the requested products ('slope', 'aspect' in degrees, 'hillshade',
+    'multidirectional' 0-255) for a DTM array and returns {product: float32 array}
+    """
+    x, y = gradients(array,cell_size)
+    results = {}
+    with np.errstate(invalid='ignore'):
+        if 'slope' in products:
+            results['slope'] = slope_degrees(x,y)
+        if 'aspect' in products:
+            results['aspect'] = aspect_degrees(x,y)
+        if 'hillshade' in products:
+            results['hillshade'] = _shade(x,y,azimuth,angle_altitude)
+        if 'multidirectional' in products:
+            results['multidirectional'] = multidirectional_hillshade(x,y,angle_altitude)
+    return results
+
+def _terrain_window(args):
+    # worker: read rows [yoff-1, yoff+ysize+1) of the DTM (clipped to the raster), compute, drop the halo
+    dtm_file, window, products, azimuth, angle_altitude = args
+    xoff, yoff, xsize, ysize = window
+    dataset = gdal.Open(dtm_file)
+    raster = dataset.GetRasterBand(1)
+    top = max(yoff-1,0)
+    bottom = min(yoff+ysize+1,dataset.RasterYSize)
+    block = np.empty((bottom-top,xsize),dtype=np.float32)
+    raster.ReadAsArray(xoff,top,xsize,bottom-top,buf_obj=block)
+    no_data = raster.GetNoDataValue()
+    if no_data is not None:
+        block[block == np.float32(no_data)] = np.nan
+    geotransform = dataset.GetGeoTransform()
+    dataset = None
+    results = terrain_block(block,products,azimuth,angle_altitude,(abs(geotransform[5]),abs(geotransform[1])))
+    return window, {name:array[yoff-top:yoff-top+ysize] for name, array in results.items()}
+
+def terrain_derivatives(dtm_file,out_files,azimuth=315,angle_altitude=45,max_pixels=1<<20,max_workers=None):
+    """
+    terrain_derivatives computes slope, aspect, hillshade and/or multi-directional hillshade
+    of a DTM GeoTIFF (eg. a full-site mosaic) over strips of rows with a process pool
+    --------
+     Inputs:
+         dtm_file: DTM GeoTIFF filename
+         out_files: dictionary {product: output GeoTIFF filename}, products from PRODUCTS
+         azimuth, angle_altitude: light direction of 'hillshade' (degrees); default 315, 45
+         max_pixels: approximate number of pixels per strip; default 1048576
+         max_workers: number of processes; default None (number of CPUs)
+    --------
+     Returns:
+         out_files
+    --------
+    Usage:
+    --------
+    terrain_derivatives('SERC_DTM_mosaic.tif',{'hillshade':'SERC_hillshade.tif','slope':'SERC_slope.tif'},225,45)
+    """
+    dataset = gdal.Open(dtm_file)
+    cols, rows = dataset.RasterXSize, dataset.RasterYSize
+    geotransform, projection = dataset.GetGeoTransform(), dataset.GetProjection()
+    windows = list(raster_windows(dataset,max_pixels))
+    dataset = None
+    outputs = {name:create_raster(filename,cols,rows,1,np.float32,geotransform,projection=projection,no_data=np.nan)
+               for name, filename in out_files.items()}
+    args = [(dtm_file,window,tuple(out_files),azimuth,angle_altitude) for window in windows]
+    with ProcessPoolExecutor(max_workers=max_workers) as executor:
+        for (xoff, yoff, xsize, ysize), results in executor.map(_terrain_window,args):
+            for name, array in results.items():
+                outputs[name].GetRasterBand(1).WriteArray(array,xoff,yoff)
+    for name in outputs:
+        outputs[name].FlushCache()
+        outputs[name] = None
+    return out_files
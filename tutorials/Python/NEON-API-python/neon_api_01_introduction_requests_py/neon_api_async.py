@@ -0,0 +1,159 @@
+# -*- coding: utf-8 -*-
+"""
+Asynchronous client for the NEON Data API, for crawling many sites, products, and months
+without waiting on one request at a time. Requires aiohttp (pip install aiohttp).
+
+The 'sites/', 'products/' and 'data/' endpoints used in the requests tutorial are available
+as coroutines, eg.
+
+    async with NeonApiClient() as client:
+        site_json = await client.get_site('TEAK')
+        async for site, month, f in client.iter_files('DP3.10003.001',['TEAK','SOAP'],['2018-06']):
+            print(site, month, f['name'], f['url'])
+
+In a script (outside of Jupyter, which already runs an event loop) use
+collect_files('DP3.10003.001',['TEAK','SOAP']) to get the same files as a list.
+"""
+
+import asyncio, random
+import aiohttp
+
+SERVER = 'http://data.neonscience.org/api/v0/'
+
+#status codes that are retried with a jittered exponential backoff
+RETRY_STATUS = (429, 500, 502, 503, 504)
+
+class NeonApiClient(object):
+    """
+    NeonApiClient sends NEON API requests over a pooled aiohttp session, with at most
+    max_concurrency requests in flight, retries with jittered backoff on 429/5xx and
+    connection errors, and a pause on all requests when the API's rate limit headers
+    (X-RateLimit-Remaining, RetryAfter) say the limit has been reached.
+    --------
+     Inputs:
+         server: API root url; default SERVER
+         max_concurrency: maximum number of requests in flight (and pooled connections); default 8
+         max_retries: number of times a failed request is retried; default 5
+         backoff: base delay in seconds, doubled after each retry; default 1.0
+         token: NEON API token sent in the X-API-Token header; default None
+         timeout: total seconds allowed for one request; default 60
+    """
+    def __init__(self,server=SERVER,max_concurrency=8,max_retries=5,backoff=1.0,token=None,timeout=60):
+        self.server = server
+        self.max_concurrency = max_concurrency
+        self.max_retries = max_retries
+        self.backoff = backoff
+        self.headers = {'X-API-Token':token} if token else {}
+        self.timeout = aiohttp.ClientTimeout(total=timeout)
+        self.session = None
+        self._semaphore = None
+        self._resume_at = 0.
+
+    async def __aenter__(self):
+        connector = aiohttp.TCPConnector(limit=self.max_concurrency)
+        self.session = aiohttp.ClientSession(connector=connector,headers=self.headers,timeout=self.timeout)
+        self._semaphore = asyncio.Semaphore(self.max_concurrency)
+        return self
+
+    async def __aexit__(self,*exc_info):
+        await self.session.close()
+        self.session = None
+
+    def _retry_delay(self,attempt):
+        # full jitter: a random delay between 0 and backoff * 2**attempt
+        return random.uniform(0,self.backoff*2**attempt)
+
+    def _update_rate_limit(self,response,attempt):
+        loop = asyncio.get_running_loop()
+        retry_after = response.headers.get('RetryAfter',response.headers.get('Retry-After'))
+        remaining = response.headers.get('X-RateLimit-Remaining')
+        if response.status == 429 or (remaining is not None and int(remaining) <= 0):
+            delay = float(retry_after) if retry_after is not None else self._retry_delay(attempt)
+            self._resume_at = max(self._resume_at,loop.time() + delay)
+
+    async def _wait_for_rate_limit(self):
+        delay = self._resume_at - asyncio.get_running_loop().time()
+        if delay > 0:
+            await asyncio.sleep(delay)
+
+    async def get_json(self,url):
+        """
+        get_json requests an API url (or a path relative to server, eg. 'sites/TEAK') and
+        returns the parsed json response
+        """
+        if not url.startswith('http'):
+            url = self.server + url
+        attempt = 0
+        while True:
+            async with self._semaphore:
+                await self._wait_for_rate_limit()
+                try:
+                    async with self.session.get(url) as response:
+                        self._update_rate_limit(response,attempt)
+                        if response.status not in RETRY_STATUS or attempt >= self.max_retries:
+                            response.raise_for_status()
+                            return await response.json()
+                except (aiohttp.ClientConnectionError,asyncio.TimeoutError):
+                    if attempt >= self.max_retries:
+                        raise
+            await asyncio.sleep(self._retry_delay(attempt))
+            attempt += 1
+
+    async def get_site(self,site):
+        # site_json equivalent of requests.get(SERVER+'sites/'+site).json()
+        return await self.get_json('sites/' + site)
+
+    async def get_product(self,product):
+        # product_json equivalent of requests.get(SERVER+'products/'+product).json()
+        return await self.get_json('products/' + product)
+
+    async def get_data(self,product,site,month):
+        # data_json equivalent of requests.get(SERVER+'data/'+product+'/'+site+'/'+month).json()
+        return await self.get_json('data/' + product + '/' + site + '/' + month)
+
+    async def iter_files(self,product,sites,months=None):
+        """
+        iter_files requests the data/ endpoint for every site and month concurrently and
+        yields (site, month, file dictionary) as each response arrives
+        --------
+         Inputs:
+             product: the data product code (eg. 'DP3.10003.001')
+             sites: list of 4-digit NEON site codes (eg. ['TEAK','SOAP'])
+             months: list of months (eg. ['2018-06','2019-06']); default None uses the
+                     available months of each site from the products/ endpoint
+        """
+        if months is None:
+            product_json = await self.get_product(product)
+            available = {s['siteCode']:s['availableMonths'] for s in product_json['data']['siteCodes']}
+            queries = [(site,month) for site in sites for month in available.get(site,[])]
+        else:
+            queries = [(site,month) for site in sites for month in months]
+
+        async def fetch(site,month):
+            try:
+                return site, month, await self.get_data(product,site,month)
+            except aiohttp.ClientResponseError as e:
+                if e.status == 404: # no data for this site and month
+                    return site, month, None
+                raise
+
+        for task in asyncio.as_completed([fetch(site,month) for site, month in queries]):
+            site, month, data_json = await task
+            if data_json is None:
+                continue
+            for f in data_json['data']['files']:
+                yield site, month, f
+
+def collect_files(product,sites,months=None,**client_args):
+    """
+    collect_files runs NeonApiClient.iter_files to completion and returns a list of
+    (site, month, file dictionary); extra keyword arguments are passed to NeonApiClient
+    --------
+    Usage:
+    --------
+    files = collect_files('DP3.10003.001',['TEAK','SOAP'],max_concurrency=16)
+    """
+    async def run():
+        async with NeonApiClient(**client_args) as client:
+            return [f async for f in client.iter_files(product,sites,months)]
+    return asyncio.run(run())